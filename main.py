@@ -7,7 +7,26 @@ from functools import partial
 import random
 import sys
 import multiprocessing
-import string
+import hashlib
+import json
+import tempfile
+import shutil
+import time
+import fcntl
+from contextlib import contextmanager, nullcontext
+import queue
+import asyncio
+import signal
+import re
+import math
+import threading
+import ctypes
+import struct
+import socket
+import mmap
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from functools import lru_cache
+from abc import ABC, abstractmethod
 
 
 
@@ -34,7 +53,410 @@ else:
         #"sand_cfisan"
     ])
 
-def build_variant(path: str, variant: str, extra_flags: dict):
+def argv_value(name: str, default):
+    # "name=value" style options, like nprocs=16
+    for arg in sys.argv[1:]:
+        if arg.startswith(name + "="):
+            return type(default)(arg.split("=", 1)[1])
+    return default
+
+def cgroup_cpu_limit():
+    # cpu quota of our cgroup in whole cpus, None when unlimited (v2 first, then v1)
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return -(-int(quota) // int(period))
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0:
+            return -(-quota // period)
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cpus() -> int:
+    cpus = len(os.sched_getaffinity(0))
+    limit = cgroup_cpu_limit()
+    return max(1, min(cpus, limit)) if limit else cpus
+
+class JobServer:
+    # GNU make style jobserver (a fifo holding one byte per job token) shared by every ninja we
+    # launch. a ninja owns one implicit token, so each build takes one out of the fifo for as
+    # long as its ninja runs and gives it back afterwards; whatever a finished build leaves
+    # behind is picked up by the builds still running
+
+    def __init__(self, jobs: int, clients: int):
+        self.jobs = jobs
+        self.clients = clients
+        self.dir = tempfile.mkdtemp(prefix="fuzz_jobserver_")
+        self.path = os.path.join(self.dir, "fifo")
+        os.mkfifo(self.path)
+        # keep a read/write handle open so the fifo never sees EOF while clients come and go
+        self.fd = os.open(self.path, os.O_RDWR)
+        os.write(self.fd, b"+" * jobs)
+
+    @contextmanager
+    def slot(self):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            token = os.read(fd, 1)
+            try:
+                yield
+            finally:
+                os.write(fd, token)
+        finally:
+            os.close(fd)
+
+    def share(self) -> int:
+        return max(1, self.jobs // self.clients)
+
+    def makeflags(self) -> str:
+        return f"-j{self.jobs} --jobserver-auth=fifo:{self.path}"
+
+    def close(self):
+        os.close(self.fd)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+@lru_cache(maxsize=None)
+def ninja_supports_jobserver() -> bool:
+    # ninja only became a jobserver client in 1.13
+    try:
+        version = subprocess.run(["ninja", "--version"], capture_output=True, text=True, check=True).stdout
+        return tuple(int(x) for x in version.strip().split(".")[:2]) >= (1, 13)
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return False
+
+# what a full LTO link is assumed to need before we've ever seen it run
+DEFAULT_LINK_RSS_MB = 8192
+LINK_ADMISSION_STATE = Path(tempfile.gettempdir()) / "fuzz_link_admission.json"
+LINK_TIMES_LOG = ".fuzz_link_times.log"
+
+def total_memory_mb() -> int:
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) // 1024
+    raise RuntimeError("MemTotal missing from /proc/meminfo")
+
+@contextmanager
+def locked_json(path: Path):
+    # read-modify-write a small json file shared between concurrent link steps
+    with open(str(path) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            data = {}
+        yield data
+        tmp = Path(str(path) + ".tmp")
+        tmp.write_text(json.dumps(data, indent=2, sort_keys=True))
+        tmp.replace(path)
+
+def run_measured(args: list, timeout: float = None, **kwargs):
+    # like subprocess.run, but also returns wall seconds and the rusage of the process tree.
+    # a process still running after timeout seconds is killed
+    start = time.monotonic()
+    proc = subprocess.Popen(args, **kwargs)
+    timer = threading.Timer(timeout, proc.kill) if timeout else None
+    if timer:
+        timer.start()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if timer:
+        timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, time.monotonic() - start, rusage
+
+def check_measured(args: list, **kwargs):
+    ret, seconds, rusage = run_measured(args, **kwargs)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, args)
+    return seconds, rusage
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def link_gate(variant: str, stats_path: str, cmd: list) -> int:
+    # runs as CMAKE_<LANG>_LINKER_LAUNCHER: waits until the link's projected peak RSS fits in
+    # the memory budget next to the links already running, runs it, and records how much it
+    # really used so the next build of this variant is admitted on real numbers
+    stats_path = Path(stats_path)
+    output = cmd[cmd.index("-o") + 1] if "-o" in cmd else cmd[-1]
+    budget = int(os.environ.get("FUZZ_LINK_BUDGET_MB", 0)) or total_memory_mb()
+
+    with locked_json(stats_path) as stats:
+        history = stats.get(variant, {})
+        estimate = history.get(output) or max(history.values(), default=0) \
+            or max((max(h.values(), default=0) for h in stats.values()), default=0) or DEFAULT_LINK_RSS_MB
+    # a link that can never fit still runs, it just has to run alone
+    estimate = min(estimate, budget)
+
+    me = str(os.getpid())
+    announced = False
+    while True:
+        with locked_json(LINK_ADMISSION_STATE) as running:
+            for pid in [p for p in running if not pid_alive(int(p))]:
+                del running[pid]
+            if not running or sum(running.values()) + estimate <= budget:
+                running[me] = estimate
+                break
+        if not announced:
+            print(f"linkgate: {variant} {output} waiting for {estimate} MB of {budget} MB link budget", flush=True)
+            announced = True
+        time.sleep(1)
+
+    if os.environ.get("FUZZ_LINK_THREADS"):
+        cmd = cmd[:1] + [f"-Wl,--threads={os.environ['FUZZ_LINK_THREADS']}"] + cmd[1:]
+    start = time.time()
+    try:
+        ret, _, rusage = run_measured(cmd)
+    finally:
+        with locked_json(LINK_ADMISSION_STATE) as running:
+            running.pop(me, None)
+
+    if ret == 0:
+        with locked_json(stats_path) as stats:
+            stats.setdefault(variant, {})[output] = rusage.ru_maxrss // 1024
+        # ninja runs us in the build directory; build_variant turns these into link time
+        with open(LINK_TIMES_LOG, "a") as f:
+            f.write(f"{start} {time.time()} {rusage.ru_maxrss}\n")
+    return ret
+
+def link_seconds(log: Path) -> float:
+    # wall time during which at least one link step was running
+    try:
+        intervals = sorted(tuple(map(float, line.split()[:2])) for line in log.read_text().splitlines())
+    except OSError:
+        return 0.0
+    total, end = 0.0, 0.0
+    for start, stop in intervals:
+        start = max(start, end)
+        if stop > start:
+            total += stop - start
+            end = stop
+    return total
+
+# with -flto the compile step only emits bitcode and afl-clang-lto applies these at link time,
+# so they don't make two compiles of the same translation unit differ
+LTO_LINK_ONLY_ENV = {"AFL_LLVM_CMPLOG", "AFL_LLVM_LAF_ALL", "AFL_SAN_NO_INST"}
+
+def object_cache_key(cmd: list, source: bytes) -> str:
+    # the effective invocation: compiler identity, flags that don't affect preprocessing,
+    # instrumentation env vars and the preprocessed source. -D/-I/-U are already reflected in
+    # the preprocessed text, and the build directory is normalized away so that variants
+    # configured identically hash identically
+    build_dir = os.getcwd()
+    lto = any(a.startswith("-flto") for a in cmd)
+    h = hashlib.sha256(compiler_version(cmd[0]).encode())
+    skip = False
+    for arg in cmd[1:]:
+        if skip:
+            skip = False
+            continue
+        if arg in ("-o", "-MF", "-MT", "-MQ", "-D", "-I", "-U"):
+            skip = True
+            continue
+        if arg[:2] in ("-D", "-I", "-U") or arg in ("-MD", "-MMD"):
+            continue
+        h.update(arg.replace(build_dir, "<build>").encode() + b"\0")
+    for k, v in sorted(os.environ.items()):
+        if k.startswith("AFL_") and not (lto and k in LTO_LINK_ONLY_ENV):
+            h.update(f"{k}={v}\0".encode())
+    h.update(source.replace(build_dir.encode(), b"<build>"))
+    return h.hexdigest()
+
+def object_cache(cache_dir: str, variant: str, cmd: list) -> int:
+    # runs as CMAKE_<LANG>_COMPILER_LAUNCHER: preprocesses the translation unit (which also
+    # writes the depfile ninja wants) and reuses an object another variant already compiled
+    # with the same effective invocation
+    if "-c" not in cmd or "-o" not in cmd:
+        return subprocess.run(cmd).returncode
+    output = cmd[cmd.index("-o") + 1]
+    pp_cmd = ["-E" if a == "-c" else a for a in cmd]
+    del pp_cmd[pp_cmd.index("-o"):pp_cmd.index("-o") + 2]
+    pp = subprocess.run(pp_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if pp.returncode != 0:
+        # let the real compile report the error
+        return subprocess.run(cmd).returncode
+
+    cache_dir = Path(cache_dir)
+    key = object_cache_key(cmd, pp.stdout)
+    entry = cache_dir / key[:2] / (key + ".o")
+    hit = entry.exists()
+    if hit:
+        Path(output).unlink(missing_ok=True)
+        try:
+            os.link(entry, output)
+        except OSError:
+            shutil.copyfile(entry, output)
+        # ninja compares the object's mtime against its inputs, and the entry's mtime is its LRU timestamp
+        os.utime(output)
+        os.utime(entry)
+        ret = 0
+    else:
+        ret = subprocess.run(cmd).returncode
+        if ret == 0:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+            shutil.copyfile(output, tmp)
+            tmp.replace(entry)
+    if ret == 0:
+        # single short appends to an O_APPEND file don't interleave between processes
+        with open(cache_dir / "stats.log", "a") as f:
+            f.write(f"{variant} {'hit' if hit else 'miss'}\n")
+    return ret
+
+def object_cache_report(cache_dir: Path, offset: int):
+    counts = {}
+    try:
+        with open(cache_dir / "stats.log") as f:
+            f.seek(offset)
+            for line in f:
+                variant, result = line.split()
+                counts.setdefault(variant, {"hit": 0, "miss": 0})[result] += 1
+    except OSError:
+        return
+    hits = sum(c["hit"] for c in counts.values())
+    total = hits + sum(c["miss"] for c in counts.values())
+    for variant, c in sorted(counts.items()):
+        n = c["hit"] + c["miss"]
+        print(f"object cache: {variant:16} {c['hit']:6}/{n:<6} hits ({100 * c['hit'] / n:.1f}%)")
+    if total:
+        print(f"object cache: {'total':16} {hits:6}/{total:<6} hits ({100 * hits / total:.1f}%)")
+    # reported, so the next build starts a fresh log
+    (cache_dir / "stats.log").write_text("")
+
+def object_cache_evict(cache_dir: Path, max_bytes: int):
+    entries = []
+    for entry in cache_dir.glob("*/*.o"):
+        try:
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        entry.unlink(missing_ok=True)
+        total -= size
+        evicted += 1
+    if evicted:
+        print(f"object cache: evicted {evicted} objects, {total >> 20} MB left")
+
+@lru_cache(maxsize=None)
+def compiler_version(cc: str) -> str:
+    ret = subprocess.run([cc.strip(), "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return ret.stdout.strip()
+
+@lru_cache(maxsize=None)
+def native_target(cc: str) -> str:
+    # what -march=native resolves to on this host: the predefined macros carry every enabled
+    # instruction set extension (__AVX512F__, ...), so hosts with different cpus differ here
+    ret = subprocess.run([cc.strip(), "-march=native", "-dM", "-E", "-x", "c", os.devnull],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return "\n".join(sorted(ret.stdout.splitlines()))
+
+def source_revision(path: str):
+    # HEAD plus any uncommitted changes; None means we can't tell and must always build
+    git = ["git", "-C", path]
+    try:
+        head = subprocess.run(git + ["rev-parse", "HEAD"], capture_output=True, check=True).stdout
+        diff = subprocess.run(git + ["diff", "HEAD", "--", ".", ":(exclude)build_*", ":(exclude).fuzz_*"],
+                              capture_output=True, check=True).stdout
+        untracked = subprocess.run(git + ["ls-files", "--others", "--exclude-standard", "--", ".", ":(exclude)build_*",
+                                          ":(exclude).fuzz_*"],
+                                   capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    h = hashlib.sha256(head)
+    h.update(diff)
+    for name in sorted(untracked.splitlines()):
+        h.update(name)
+        try:
+            h.update((Path(path) / name.decode()).read_bytes())
+        except OSError:
+            pass
+    return h.hexdigest()
+
+def config_hash(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+def store_key(manifest: dict, args: list, env_vars: dict, native: str) -> str:
+    # like the manifest, but without the launcher arguments, which carry host specific paths,
+    # and with the host cpu: -march=native and GGML_NATIVE binaries SIGILL on a cpu that lacks
+    # an extension the publishing host had
+    return config_hash({
+        "source": manifest["source"],
+        "compiler": manifest["compiler"],
+        "native": native,
+        "args": [a for a in args if "_LAUNCHER=" not in a],
+        "env": env_vars,
+    })
+
+def store_fetch(store: Path, key: str, build_path: Path, executable: str) -> bool:
+    entry = store / key[:2] / key
+    if not (entry / executable).is_file():
+        return False
+    dest = build_path / executable
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(dest.name + ".fetch")
+    shutil.copy2(entry / executable, tmp)
+    tmp.replace(dest)
+    # the entry's mtime is its LRU timestamp
+    os.utime(entry)
+    return True
+
+def store_publish(store: Path, key: str, build_path: Path, executable: str, max_bytes: int):
+    entry = store / key[:2] / key
+    if entry.exists():
+        os.utime(entry)
+        return
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # fill a private directory and rename it into place, so other hosts sharing the store
+    # never see a half written entry
+    tmp = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=entry.parent))
+    (tmp / executable).parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(build_path / executable, tmp / executable)
+    shutil.copy2(build_path / "fuzz_manifest.json", tmp / "fuzz_manifest.json")
+    try:
+        tmp.rename(entry)
+    except OSError:
+        # someone else published the same key first
+        shutil.rmtree(tmp, ignore_errors=True)
+    store_evict(store, max_bytes)
+
+def store_evict(store: Path, max_bytes: int):
+    entries = []
+    for entry in store.glob("*/*"):
+        if entry.name.startswith("."):
+            continue
+        try:
+            size = sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+            entries.append((entry.stat().st_mtime, size, entry))
+        except OSError:
+            # evicted by someone else while we looked at it
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        print(f"artifact store: evicting {entry.name} ({size} bytes)")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def build_variant(path: str, variant: str, extra_flags: dict, jobserver: JobServer = None,
+                  executable: str = "bin/test-fuzz"):
     assert variant in VARIANTS
 
     build_dir = "build_" + variant
@@ -66,7 +488,7 @@ def build_variant(path: str, variant: str, extra_flags: dict):
 
     #-stdlib=libc++ --rtlib=compiler-rt -unwind=libunwind
     ccflags =   f"  -w -Wno-error -g3 -march=native  -fno-omit-frame-pointer "
-    linkflags = f"    -g3 -fuse-ld=lld  -fno-omit-frame-pointer -Wl,--threads=32 "
+    linkflags = f"    -g3 -fuse-ld=lld  -fno-omit-frame-pointer "
 
     if "nosan" not in sys.argv or "nosan" in variant:
         ccflags +=   f" -fno-sanitize-recover=all {sanitize_string} "
@@ -95,7 +517,6 @@ def build_variant(path: str, variant: str, extra_flags: dict):
         ccflags +=   " -O3 "
         linkflags += " -Wl,-O3 "
 
-    ccflags += f" -DFUZZING_UNIQUE=\"{''.join(random.choice(string.ascii_letters) for _ in range(32))}\" "
     if "unstable" in sys.argv:
         ccflags += " -DFUZZING_UNSTABLE "
     else:
@@ -112,6 +533,16 @@ def build_variant(path: str, variant: str, extra_flags: dict):
         "CMAKE_CXX_FLAGS": ccflags,
     }
 
+    link_launcher = [sys.executable, str(Path(__file__).resolve()), "linkgate", variant,
+                     str(Path(path).resolve() / ".fuzz_link_rss.json"), "--"]
+    cmake_flags["CMAKE_C_LINKER_LAUNCHER"] = ";".join(link_launcher)
+    cmake_flags["CMAKE_CXX_LINKER_LAUNCHER"] = ";".join(link_launcher)
+    if "nocache" not in sys.argv:
+        compile_launcher = [sys.executable, str(Path(__file__).resolve()), "objcache",
+                            str(Path(path).resolve() / ".fuzz_objcache"), variant, "--"]
+        cmake_flags["CMAKE_C_COMPILER_LAUNCHER"] = ";".join(compile_launcher)
+        cmake_flags["CMAKE_CXX_COMPILER_LAUNCHER"] = ";".join(compile_launcher)
+
     env_vars = {
         "nofuzz": {},
         "nosan": {},
@@ -137,6 +568,21 @@ def build_variant(path: str, variant: str, extra_flags: dict):
 
     }[variant]
 
+    # FUZZING_UNIQUE is derived from the compile side of the configuration so an unchanged
+    # configuration keeps the same define across runs (ninja can reuse objects instead of
+    # recompiling the world), and variants that compile identically can share objects
+    lto = "-flto" in ccflags
+    config = {
+        "compiler": compiler_version(cc),
+        "cc": [cc, cxx],
+        "ccflags": ccflags,
+        "extra_flags": extra_flags,
+        "env": {k: v for k, v in env_vars.items() if not (lto and k in LTO_LINK_ONLY_ENV)},
+    }
+    unique = config_hash(config)[:32]
+    cmake_flags["CMAKE_C_FLAGS"] += f" -DFUZZING_UNIQUE=\"{unique}\" "
+    cmake_flags["CMAKE_CXX_FLAGS"] += f" -DFUZZING_UNIQUE=\"{unique}\" "
+
     args = ["cmake", "..", "-G", "Ninja"]
 
     for k, v in cmake_flags.items():
@@ -151,182 +597,869 @@ def build_variant(path: str, variant: str, extra_flags: dict):
 
     env = os.environ.copy()
     env.update(env_vars)
+    link_budget_mb = int(argv_value("linkmem", 0.0) * 1024)
+    if link_budget_mb:
+        env["FUZZ_LINK_BUDGET_MB"] = str(link_budget_mb)
+    # the link gate passes this to lld, it stays out of the cmake flags so the build's share
+    # of the machine never changes the manifest or the artifact store key
+    env["FUZZ_LINK_THREADS"] = str(jobserver.share() if jobserver else 32)
 
-    if build_path.exists():
-        subprocess.run(["rm", "-rf", str(build_path)], check=True)
-    build_path.mkdir()
-    subprocess.run(args, env=env, check=True, cwd=build_path)
-
-    subprocess.run(["ninja","-k","0"], env=env, check=True, cwd=build_path)
-
-
-
-
-def build_target(path, variants, flags):
-    build_configs = [(path, v, flags) for v in variants]
-
-    nprocs=1
-    if "nprocs=16" in sys.argv:
-        nprocs = 16
-    elif "nprocs=8" in sys.argv:
-        nprocs = 5
-
-    with Pool(nprocs) as pool:
-        pool.starmap(build_variant, build_configs)
-
-def ggml():
-    extra_flags = {
-        "GGML_BACKEND_DL":"OFF",
-        "GGML_STATIC":"ON",
-        "GGML_NATIVE":"ON",
-        "GGML_LTO":"OFF",
-        "GGML_BUILD_EXAMPLES":"ON" if "nofuzz" in sys.argv else "OFF",
-        "GGML_BUILD_TESTS":"ON",
-        "GGML_CPU_AARCH64":"OFF",
-        "GGML_AVX":"ON",
-        "GGML_AVX2":"ON",
-        "GGML_FMA":"OFF",
-        "GGML_F16C":"OFF",
-        "GGML_LASX":"OFF",
-        "GGML_LSX":"OFF",
-        "GGML_RVV":"OFF",
-        "GGML_CPU_ALL_VARIANTS":"OFF",
-        "GGML_ACCELERATE":"OFF",
-        "GGML_BLAS":"OFF",
-        "GGML_LLAMAFILE":"OFF",
-        "GGML_OPENMP":"OFF",
-        "GGML_OPENCL_EMBED_KERNELS":"OFF",
+    manifest = {
+        "source": source_revision(path),
+        "config": config_hash({"args": args, "env": env_vars}),
+        "compiler": config["compiler"],
+        "complete": True,
+    }
+    manifest_path = build_path / "fuzz_manifest.json"
+    try:
+        old_manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        old_manifest = None
+    configured = (build_path / "build.ninja").exists()
+    built = configured or (build_path / executable).exists()
 
+    report = {
+        "variant": variant,
+        "skipped": False,
+        "fetched": False,
+        "configure_seconds": 0.0,
+        "compile_seconds": 0.0,
+        "link_seconds": 0.0,
+        "cpu_seconds": 0.0,
+        "peak_rss_mb": 0,
     }
-    build_target("targets/ggml", VARIANTS, extra_flags)
-
-
-def llama_cpp():
-    extra_flags = {
-        "GGML_BACKEND_DL":"OFF",
-        "GGML_STATIC":"ON",
-        "GGML_NATIVE":"ON",
-        "GGML_LTO":"OFF",
-        "GGML_BUILD_EXAMPLES":"OFF",
-        "GGML_BUILD_TESTS":"OFF",
-        "LLAMA_ALL_WARNINGS":"OFF",
-        "LLAMA_BUILD_EXAMPLES":"OFF",
-        "LLAMA_BUILD_TESTS":"ON",
-        "GGML_CPU_AARCH64":"OFF",
-        "GGML_BMI2":"ON",
-        "GGML_SSE42":"ON",
-        "GGML_AVX":"ON",
-        "GGML_AVX2":"ON",
-        "GGML_FMA":"ON",
-        "GGML_F16C":"ON",
-        "GGML_LASX":"OFF",
-        "GGML_LSX":"OFF",
-        "GGML_RVV":"OFF",
-        "GGML_CPU_ALL_VARIANTS":"OFF",
-        "GGML_ACCELERATE":"OFF",
-        "GGML_BLAS":"OFF",
-        "GGML_LLAMAFILE":"OFF",
-        "GGML_OPENMP":"ON",
-        "GGML_OPENCL_EMBED_KERNELS":"OFF",
-        "LLAMA_CURL":"OFF",
+
+    if "clean" not in sys.argv and built and manifest["source"] is not None and old_manifest == manifest:
+        print(f"{build_path}: up to date, skipping")
+        report["skipped"] = True
+        report["artifacts"] = artifact_sizes(build_path, executable)
+        return report
+
+    store = argv_value("store", "")
+    if store and manifest["source"] is not None:
+        store = Path(store)
+        key = store_key(manifest, args, env_vars, native_target(cc))
+        if "clean" not in sys.argv and store_fetch(store, key, build_path, executable):
+            print(f"{build_path}: fetched {executable} from artifact store ({key[:12]})")
+            manifest_path.write_text(json.dumps(manifest, indent=2))
+            report["fetched"] = True
+            report["artifacts"] = artifact_sizes(build_path, executable)
+            return report
+
+    if "clean" in sys.argv or (old_manifest is not None and old_manifest.get("compiler") != manifest["compiler"]):
+        # the compiler changed underneath ninja's feet
+        if build_path.exists():
+            subprocess.run(["rm", "-rf", str(build_path)], check=True)
+        build_path.mkdir()
+        configured = False
+    else:
+        # keep ninja's state, a failed or interrupted build only marks the manifest
+        # incomplete so it is never mistaken for an up to date one
+        build_path.mkdir(exist_ok=True)
+        if old_manifest is not None:
+            manifest_path.write_text(json.dumps({**old_manifest, "complete": False}, indent=2))
+
+    usages = []
+    if not configured or old_manifest is None or old_manifest.get("config") != manifest["config"]:
+        report["configure_seconds"], rusage = check_measured(args, env=env, cwd=build_path)
+        usages.append(rusage)
+
+    ninja_args = ["ninja","-k","0"]
+    if jobserver and ninja_supports_jobserver():
+        env["MAKEFLAGS"] = jobserver.makeflags()
+    elif jobserver:
+        # old ninja can't take tokens from the pool, so give it a fixed slice of it instead
+        ninja_args += ["-j", str(jobserver.share())]
+    link_log = build_path / LINK_TIMES_LOG
+    link_log.unlink(missing_ok=True)
+    with jobserver.slot() if jobserver and ninja_supports_jobserver() else nullcontext():
+        ninja_seconds, rusage = check_measured(ninja_args, env=env, cwd=build_path)
+    usages.append(rusage)
+
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    if store and manifest["source"] is not None and (build_path / executable).is_file():
+        store_publish(store, key, build_path, executable, int(argv_value("storemax", 50.0) * 2**30))
+
+    report["configure_seconds"] = round(report["configure_seconds"], 3)
+    report["link_seconds"] = round(link_seconds(link_log), 3)
+    report["compile_seconds"] = round(max(0.0, ninja_seconds - report["link_seconds"]), 3)
+    report["cpu_seconds"] = round(sum(u.ru_utime + u.ru_stime for u in usages), 3)
+    report["peak_rss_mb"] = max(u.ru_maxrss for u in usages) // 1024
+    report["artifacts"] = artifact_sizes(build_path, executable)
+    return report
+
+
+
+
+def artifact_sizes(build_path: Path, executable: str) -> dict:
+    # everything in bin/, plus the fuzz executable where a target builds it elsewhere
+    bin_dir = build_path / "bin"
+    sizes = {f.name: f.stat().st_size for f in sorted(bin_dir.iterdir()) if f.is_file()} if bin_dir.is_dir() else {}
+    if Path(executable).parent != Path("bin") and (build_path / executable).is_file():
+        sizes[executable] = (build_path / executable).stat().st_size
+    return sizes
+
+def write_build_report(path: str, reports: list):
+    report_path = Path(path) / "build_report.json"
+    report_path.write_text(json.dumps({
+        "target": path,
+        "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "variants": sorted(reports, key=lambda r: r["variant"]),
+    }, indent=2))
+    print(f"{'variant':16} {'configure':>10} {'compile':>10} {'link':>10} {'cpu':>10} {'rss MB':>8}")
+    for r in sorted(reports, key=lambda r: -(r["configure_seconds"] + r["compile_seconds"] + r["link_seconds"])):
+        print(f"{r['variant']:16} {r['configure_seconds']:10.1f} {r['compile_seconds']:10.1f} "
+              f"{r['link_seconds']:10.1f} {r['cpu_seconds']:10.1f} {r['peak_rss_mb']:8}")
+    print(f"build report written to {report_path}")
+
+GGML_FLAGS = {
+    "GGML_BACKEND_DL":"OFF",
+    "GGML_STATIC":"ON",
+    "GGML_NATIVE":"ON",
+    "GGML_LTO":"OFF",
+    "GGML_BUILD_EXAMPLES":"ON" if "nofuzz" in sys.argv else "OFF",
+    "GGML_BUILD_TESTS":"ON",
+    "GGML_CPU_AARCH64":"OFF",
+    "GGML_AVX":"ON",
+    "GGML_AVX2":"ON",
+    "GGML_FMA":"OFF",
+    "GGML_F16C":"OFF",
+    "GGML_LASX":"OFF",
+    "GGML_LSX":"OFF",
+    "GGML_RVV":"OFF",
+    "GGML_CPU_ALL_VARIANTS":"OFF",
+    "GGML_ACCELERATE":"OFF",
+    "GGML_BLAS":"OFF",
+    "GGML_LLAMAFILE":"OFF",
+    "GGML_OPENMP":"OFF",
+    "GGML_OPENCL_EMBED_KERNELS":"OFF",
+
+}
+
+LLAMA_CPP_FLAGS = {
+    "GGML_BACKEND_DL":"OFF",
+    "GGML_STATIC":"ON",
+    "GGML_NATIVE":"ON",
+    "GGML_LTO":"OFF",
+    "GGML_BUILD_EXAMPLES":"OFF",
+    "GGML_BUILD_TESTS":"OFF",
+    "LLAMA_ALL_WARNINGS":"OFF",
+    "LLAMA_BUILD_EXAMPLES":"OFF",
+    "LLAMA_BUILD_TESTS":"ON",
+    "GGML_CPU_AARCH64":"OFF",
+    "GGML_BMI2":"ON",
+    "GGML_SSE42":"ON",
+    "GGML_AVX":"ON",
+    "GGML_AVX2":"ON",
+    "GGML_FMA":"ON",
+    "GGML_F16C":"ON",
+    "GGML_LASX":"OFF",
+    "GGML_LSX":"OFF",
+    "GGML_RVV":"OFF",
+    "GGML_CPU_ALL_VARIANTS":"OFF",
+    "GGML_ACCELERATE":"OFF",
+    "GGML_BLAS":"OFF",
+    "GGML_LLAMAFILE":"OFF",
+    "GGML_OPENMP":"ON",
+    "GGML_OPENCL_EMBED_KERNELS":"OFF",
+    "LLAMA_CURL":"OFF",
+}
+
+WHISPER_CPP_FLAGS = {
+    "GGML_BACKEND_DL":"OFF",
+    "GGML_STATIC":"ON",
+    "GGML_NATIVE":"ON",
+    "GGML_LTO":"OFF",
+    "GGML_CPU_AARCH64":"OFF",
+    "GGML_AVX":"ON",
+    "GGML_AVX2":"ON",
+    "GGML_FMA":"ON",
+    "GGML_F16C":"ON",
+    "GGML_CPU_ALL_VARIANTS":"OFF",
+    "GGML_ACCELERATE":"OFF",
+    "GGML_BLAS":"OFF",
+    "GGML_OPENMP":"OFF",
+    "WHISPER_BUILD_EXAMPLES":"OFF",
+    "WHISPER_BUILD_TESTS":"ON",
+    "WHISPER_BUILD_SERVER":"OFF",
+    "WHISPER_SDL2":"OFF",
+    "WHISPER_CURL":"OFF",
+}
+
+LIBSSH_FLAGS = {
+    "WITH_FUZZING":"ON",
+    "WITH_EXAMPLES":"OFF",
+    "UNIT_TESTING":"OFF",
+    "CLIENT_TESTING":"OFF",
+    "WITH_GSSAPI":"OFF",
+    "WITH_SERVER":"ON",
+}
+
+# everything main.py knows how to build and fuzz. deps name targets whose build of the same
+# variant has to finish first. targets/llamafile is left out: it builds with cosmocc through
+# its own Makefile rather than cmake
+TARGETS = {
+    "ggml": {"path": "targets/ggml", "flags": GGML_FLAGS, "deps": [],
+             "corpus": "corpus/gguf", "executable": "bin/test-fuzz"},
+    "llama.cpp": {"path": "targets/llama.cpp", "flags": LLAMA_CPP_FLAGS, "deps": [],
+                  "corpus": "corpus/llama", "executable": "bin/test-fuzz"},
+    "whisper.cpp": {"path": "targets/whisper.cpp", "flags": WHISPER_CPP_FLAGS, "deps": [],
+                    "corpus": "corpus/whisper", "executable": "bin/test-fuzz"},
+    "libssh": {"path": "targets/libssh", "flags": LIBSSH_FLAGS, "deps": [],
+               "corpus": "corpus/libssh", "executable": "tests/fuzz/ssh_server_fuzzer"},
+}
+
+def previous_build_seconds(path: str) -> dict:
+    try:
+        report = json.loads((Path(path) / "build_report.json").read_text())
+    except (OSError, ValueError):
+        return {}
+    return {r["variant"]: r["configure_seconds"] + r["compile_seconds"] + r["link_seconds"]
+            for r in report["variants"] if not r["skipped"] and not r.get("fetched")}
+
+def build_targets(names: list, variants):
+    # one DAG of (target, variant) builds run by a single pool under a single jobserver and
+    # link memory budget. ready builds are started longest first, going by the last build
+    # report, so the long llama.cpp LTO links start early and short ggml builds fill the gaps
+    nodes = [(name, v) for name in names for v in variants]
+    nprocs = min(argv_value("nprocs", 1), len(nodes))
+    jobserver = JobServer(argv_value("jobs", available_cpus()), nprocs)
+
+    cost = {}
+    cache_offsets = {}
+    for name in names:
+        path = TARGETS[name]["path"]
+        seconds = previous_build_seconds(path)
+        for v in variants:
+            # never built before: assume the worst so it isn't left for last
+            cost[(name, v)] = seconds.get(v, float("inf"))
+        cache_dir = Path(path).resolve() / ".fuzz_objcache"
+        cache_dir.mkdir(exist_ok=True)
+        stats_log = cache_dir / "stats.log"
+        cache_offsets[name] = stats_log.stat().st_size if stats_log.exists() else 0
+
+    pending = sorted(nodes, key=lambda n: -cost[n])
+    done = set()
+    failed = {}
+    reports = {name: [] for name in names}
+    finished = queue.Queue()
+
+    def ready(node):
+        name, v = node
+        return all((dep, v) in done for dep in TARGETS[name]["deps"])
+
+    try:
+        with Pool(nprocs) as pool:
+            running = 0
+            while pending or running:
+                # builds whose dependency failed can never become ready
+                for node in [n for n in pending if any((d, n[1]) in failed for d in TARGETS[n[0]]["deps"])]:
+                    pending.remove(node)
+                    failed[node] = "dependency failed"
+                for node in [n for n in pending if ready(n)][:nprocs - running]:
+                    pending.remove(node)
+                    target = TARGETS[node[0]]
+                    pool.apply_async(build_variant, (target["path"], node[1], target["flags"], jobserver,
+                                                     target["executable"]),
+                                     callback=lambda r, node=node: finished.put((node, r, None)),
+                                     error_callback=lambda e, node=node: finished.put((node, None, e)))
+                    running += 1
+                if not running:
+                    break
+                node, report, error = finished.get()
+                running -= 1
+                if error is not None:
+                    print(f"build of {node[0]} {node[1]} failed: {error}")
+                    failed[node] = error
+                else:
+                    done.add(node)
+                    reports[node[0]].append(report)
+    finally:
+        jobserver.close()
+
+    for name in names:
+        print(f"== {name}")
+        cache_dir = Path(TARGETS[name]["path"]).resolve() / ".fuzz_objcache"
+        object_cache_report(cache_dir, cache_offsets[name])
+        object_cache_evict(cache_dir, int(argv_value("objcachemax", 10.0) * 2**30))
+        if reports[name]:
+            write_build_report(TARGETS[name]["path"], reports[name])
+    if failed:
+        raise RuntimeError(f"{len(failed)} builds failed: " + ", ".join(f"{n} {v}" for n, v in sorted(failed)))
+
+def main_instance(target, corpus, out, executable):
+    return {
+        "name": "main",
+        "variant": "main",
+        "env": {},
+        "args": ["afl-fuzz", "-t", "100", "-M", "main", "-i", corpus, "-o", out,
+                 f"./targets/{target}/build_nosan/{executable}", "@@"],
     }
-    build_target("targets/llama.cpp", VARIANTS, extra_flags)
 
-def gen_commands(target, corpus, out, executable):
-    session_name = "afl-fuzzing"
+# portfolio mode: every dimension is one independent choice, index 0 being afl's default.
+# cmplog only applies to the redqueen variants
+OPTION_SPACE = {
+    "mopt": [[], ["-L", "0"]],
+    "seed_selection": [[], ["-Z"]],
+    "schedule": [[], ["-p", "explore"], ["-p", "fast"], ["-p", "exploit"], ["-p", "seek"], ["-p", "rare"],
+                 ["-p", "mmopt"], ["-p", "coe"]],
+    "trim": [{}, {"AFL_DISABLE_TRIM": "1"}],
+    "havoc": [{}, {"AFL_EXPAND_HAVOC_NOW": "1"}],
+    "timeouts": [{}, {"AFL_KEEP_TIMEOUTS": "1"}],
+    "cmplog": [[], ["-l", "2"], ["-l", "2AT"], ["-l", "3"]],
+}
 
-    # AFL command format (without nohup/backgrounding)
-    fmt_str = "{env_args} afl-fuzz -t {timeout} {mem_limit_str} {M_or_S} {variant} -i {corpus} -o {out} {sand_str} {redqueen_str} {afl_args} {executable} @@"
+def option_dimensions(variant: str) -> list:
+    return [dim for dim in OPTION_SPACE if dim != "cmplog" or "redqueen" in variant]
 
-    cmds = []
+def random_options(variant: str) -> dict:
+    return {dim: random.randrange(len(OPTION_SPACE[dim])) for dim in option_dimensions(variant)}
+
+def options_key(options: dict) -> str:
+    return ",".join(f"{dim}={choice}" for dim, choice in sorted(options.items()))
+
+def apply_options(options: dict):
+    args, env = [], {}
+    for dim, choice in sorted(options.items()):
+        value = OPTION_SPACE[dim][choice]
+        if isinstance(value, dict):
+            env.update(value)
+        else:
+            args += value
+    return args, env
+
+def secondary_instance(target, corpus, out, executable, variant, i, options=None):
+    env = {}
+    afl_args = []
+    sand_args = []
+    redqueen_args = []
+
+    if "sand" in variant:
+        executable_path = f"./targets/{target}/build_nosan/{executable}"
+        #-w ./targets/{target}/build_sand_msan/{executable}
+        sand_args = ["-w", f"./targets/{target}/build_sand_asan/{executable}",
+                     "-w", f"./targets/{target}/build_sand_ubsan/{executable}"]
+    elif "redqueen" in variant:
+        executable_path = f"./targets/{target}/build_nosan/{executable}"
+        redqueen_args = ["-c", f"./targets/{target}/build_redqueen/{executable}"]
+    else:
+        executable_path = f"./targets/{target}/build_{variant}/{executable}"
+
+
+
+    if options is None and "portfolio" in sys.argv:
+        options = random_options(variant)
+    if options is not None:
+        option_args, option_env = apply_options(options)
+        afl_args += option_args
+        env.update(option_env)
+    else:
+        if random.randint(1,10) == 1:
+            afl_args += ["-L", "0"]
+        if random.randint(1,10) == 1:
+            afl_args += ["-Z"]
+        #if random.randint(1,3) == 1:
+        #    afl_args += " -P explore"
+        #elif random.randint(1,2) == 1:
+        #    afl_args +=  " -P exploit "
+
+        #if random.randint(1, 8) == 1:
+        #    afl_args += " -p explore "
+        #elif random.randint(1, 7) == 1:
+        #    afl_args += " -p fast "
+        #elif random.randint(1, 6) == 1:
+        #    afl_args += " -p exploit "
+        #elif random.randint(1, 5) == 1:
+        #    afl_args += " -p seek "
+        #elif random.randint(1, 4) == 1:
+        #    afl_args += " -p rare "
+        #elif random.randint(1, 3) == 1:
+        #    afl_args += " -p mmopt "
+        #elif random.randint(1, 2) == 1:
+        #    afl_args += " -p coe "
+
+        #if random.randint(1,2) == 1:
+        #    env_args += "AFL_DISABLE_TRIM=1 "
+        #if random.randint(1,2) == 1:
+        #    env_args += "AFL_KEEP_TIMEOUTS=1 "
+        #if random.randint(1,2) == 1:
+        #    env_args += "AFL_EXPAND_HAVOC_NOW=1 "
+
+        if "redqueen" in variant:
+            if random.randint(1,2) == 1:
+                afl_args += ["-l", "2"]
+            elif random.randint(1,2) == 1:
+                afl_args += ["-l", "2AT"]
+            elif random.randint(1,2) == 1:
+                afl_args += ["-l", "3"]
+
+    name = variant + str(i)
+    return {
+        "name": name,
+        "variant": variant,
+        "env": env,
+        "args": ["afl-fuzz", "-t", "10000", "-S", name, "-i", corpus, "-o", out,
+                 *sand_args, *redqueen_args, *afl_args, executable_path, "@@"],
+        "options": options,
+    }
+
+# relative share of the secondaries each variant gets; anything not listed weighs 1.
+# override with weights=nosan:4,msan:1,...
+VARIANT_WEIGHTS = {
+    "nosan": 4,
+    "redqueen": 4,
+    "laf": 2,
+    "asan": 2,
+    "ubsan": 2,
+}
+
+def variant_weights() -> dict:
+    weights = {v: VARIANT_WEIGHTS.get(v, 1) for v in VARIANTS}
+    for item in filter(None, argv_value("weights", "").split(",")):
+        variant, _, weight = item.partition(":")
+        weights[variant] = float(weight)
+    return {v: w for v, w in weights.items() if v in VARIANTS and w > 0}
+
+def allocate_instances(total: int, weights: dict) -> dict:
+    # largest remainder: exactly `total` instances, split as close to the weights as possible
+    weight_sum = sum(weights.values())
+    if total <= 0 or not weight_sum:
+        return {v: 0 for v in weights}
+    shares = {v: total * w / weight_sum for v, w in weights.items()}
+    counts = {v: int(share) for v, share in shares.items()}
+    leftover = total - sum(counts.values())
+    for v in sorted(shares, key=lambda v: shares[v] - counts[v], reverse=True)[:leftover]:
+        counts[v] += 1
+    return counts
+
+def cpu_topology() -> list:
+    # one entry per cpu we may run on: its package (socket), physical core and numa node
+    cpus = []
+    for cpu in sorted(os.sched_getaffinity(0)):
+        base = Path(f"/sys/devices/system/cpu/cpu{cpu}")
+        try:
+            package = int((base / "topology/physical_package_id").read_text())
+            core = int((base / "topology/core_id").read_text())
+        except (OSError, ValueError):
+            package, core = 0, cpu
+        nodes = [int(n.name[4:]) for n in base.glob("node[0-9]*")]
+        cpus.append({"cpu": cpu, "package": package, "core": core, "node": nodes[0] if nodes else 0})
+    return cpus
+
+def placement_order(cpus: list) -> list:
+    # one cpu per physical core first, alternating between numa nodes so a partly filled
+    # machine is balanced; smt siblings only once every core has an instance
+    by_core = {}
+    for c in cpus:
+        by_core.setdefault((c["package"], c["core"]), []).append(c)
+    order = []
+    thread = 0
+    while len(order) < len(cpus):
+        per_node = {}
+        for core in sorted(by_core):
+            if thread < len(by_core[core]):
+                c = by_core[core][thread]
+                per_node.setdefault(c["node"], []).append(c)
+        queues = [per_node[n] for n in sorted(per_node)]
+        for i in range(max(map(len, queues))):
+            order += [q[i] for q in queues if i < len(q)]
+        thread += 1
+    return order
+
+@lru_cache(maxsize=None)
+def have_numactl() -> bool:
+    return shutil.which("numactl") is not None
+
+def pin_instances(specs: list):
+    # give every instance its own cpu through afl-fuzz -b and, on multi node machines, keep
+    # its memory on that cpu's node with numactl. afl-fuzz refuses a core that is already
+    # bound, so instances beyond the cpu count stay unpinned
+    order = placement_order(cpu_topology())
+    multi_node = len({c["node"] for c in order}) > 1
+    for spec, c in zip(specs, order):
+        pin_instance(spec, c, multi_node)
+
+def pin_instance(spec: dict, c: dict, multi_node: bool):
+    spec["placement"] = c
+    args = spec["args"]
+    args[1:1] = ["-b", str(c["cpu"])]
+    if multi_node and have_numactl():
+        spec["args"] = ["numactl", f"--cpunodebind={c['node']}", f"--preferred={c['node']}"] + args
+
+def placement_report(specs: list) -> str:
+    lines = [f"{'instance':20} {'cpu':>4} {'package':>8} {'core':>5} {'node':>5}"]
+    for spec in specs:
+        c = spec.get("placement")
+        if c:
+            lines.append(f"{spec['name']:20} {c['cpu']:4} {c['package']:8} {c['core']:5} {c['node']:5}")
+    unpinned = sum(not spec.get("placement") for spec in specs)
+    if unpinned:
+        lines.append(f"warning: more instances than cpus, {unpinned} instances left unpinned")
+    return "\n".join(lines)
+
+def scratch_root() -> Path:
+    # tmpfs on any normal linux box
+    return Path(argv_value("scratch", "/dev/shm/fuzz_scratch"))
+
+def assign_scratch(specs: list, root: Path):
+    # a private TMPDIR/AFL_TMPDIR per instance, instead of every harness sharing /tmp
+    for spec in specs:
+        scratch = root / spec["name"]
+        spec["scratch"] = str(scratch)
+        spec["env"].update({"TMPDIR": str(scratch), "AFL_TMPDIR": str(scratch)})
+
+RELAY_NAME = "relay"
+
+def set_sync_dir(spec: dict, sync_dir: str):
+    args = spec["args"]
+    args[args.index("-o") + 1] = sync_dir
+    spec["sync_dir"] = sync_dir
+
+def group_instances(specs: list, out: str, group_size: int):
+    # grouped topology: instead of one -o shared by everyone (each instance rescanning every
+    # other queue, quadratic in instance count) every variant gets its own sync dirs of at most
+    # group_size instances, and a relay forwards what one group finds into the others
+    by_variant = {}
+    for spec in specs:
+        by_variant.setdefault(spec["variant"], []).append(spec)
+    for variant, members in by_variant.items():
+        n_groups = math.ceil(len(members) / group_size)
+        for i, spec in enumerate(members):
+            group = variant if n_groups == 1 else f"{variant}_{i % n_groups}"
+            set_sync_dir(spec, f"{out}/sync_{group}")
+
+def sync_dirs(specs: list) -> list:
+    return sorted({spec["sync_dir"] for spec in specs if "sync_dir" in spec})
+
+# markers the afl++ runtime embeds for __AFL_LOOP and __AFL_INIT, as checked by afl-fuzz itself
+AFL_SIGNATURES = {
+    "persistent": b"##SIG_AFL_PERSISTENT##",
+    "deferred": b"##SIG_AFL_DEFER_FORKSRV##",
+}
+
+def elf_symbol_binding(data, name: bytes):
+    # binding (1 global, 2 weak) of a defined symbol in a 64-bit little endian elf, None when
+    # the symbol isn't defined or the binary is stripped
+    if data[:4] != b"\x7fELF" or data[4] != 2 or data[5] != 1:
+        return None
+    shoff, = struct.unpack_from("<Q", data, 0x28)
+    shentsize, shnum = struct.unpack_from("<HH", data, 0x3A)
+    sections = [struct.unpack_from("<IIQQQQIIQQ", data, shoff + i * shentsize) for i in range(shnum)]
+    for sh_name, sh_type, _, _, offset, size, link, _, _, entsize in sections:
+        if sh_type not in (2, 11):  # SHT_SYMTAB, SHT_DYNSYM
+            continue
+        strtab_offset, strtab_size = sections[link][4], sections[link][5]
+        pos = data.find(b"\0" + name + b"\0", strtab_offset, strtab_offset + strtab_size)
+        if pos == -1:
+            continue
+        name_offset = pos + 1 - strtab_offset
+        for st_name, st_info, _, st_shndx, _, _ in struct.iter_unpack("<IBBHQQ", data[offset:offset + size]):
+            if st_name == name_offset and st_shndx != 0:
+                return st_info >> 4
+    return None
+
+@lru_cache(maxsize=None)
+def binary_features(path: str) -> dict:
+    # shared memory testcases: the runtime only has a weak __afl_sharedmem_fuzzing, the
+    # harness's __AFL_FUZZ_INIT() defines it for real
+    features = {"shmem": False, "persistent": False, "deferred": False}
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for feature, signature in AFL_SIGNATURES.items():
+                features[feature] = data.find(signature) != -1
+            features["shmem"] = elf_symbol_binding(data, b"__afl_sharedmem_fuzzing") == 1
+    except (OSError, ValueError, struct.error):
+        pass
+    return features
+
+def apply_delivery(spec: dict):
+    # afl-fuzz hands a test case over through shared memory when the binary takes it that way
+    # and there is no @@; otherwise every exec writes a file for the harness to open and read
+    args = spec["args"]
+    features = binary_features(args[-2]) if args[-1] == "@@" else {}
+    spec["features"] = features
+    if features.get("shmem") and "fileinput" not in sys.argv:
+        args.pop()
+        spec["delivery"] = "shmem"
+    else:
+        spec["delivery"] = "file"
+
+def delivery_report(specs: list) -> str:
+    lines = [f"{'binary':60} {'delivery':>8} {'persistent':>10} {'deferred':>8}"]
+    seen = set()
+    for spec in specs:
+        binary = next(a for a in reversed(spec["args"]) if a != "@@")
+        if binary not in seen:
+            seen.add(binary)
+            features = spec["features"]
+            lines.append(f"{binary:60} {spec['delivery']:>8} {'yes' if features.get('persistent') else 'no':>10} "
+                         f"{'yes' if features.get('deferred') else 'no':>8}")
+    return "\n".join(lines)
+
+@lru_cache(maxsize=None)
+def binary_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha1").hexdigest()
+
+def measure_execs(target_args: list, corpus: str, seconds: int) -> float:
+    # execs/s of a short standalone afl-fuzz run in a throwaway output dir
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "AFL_NO_UI": "1", "AFL_SKIP_CPUFREQ": "1"}
+        try:
+            subprocess.run(["afl-fuzz", "-V", str(seconds), "-i", corpus, "-o", tmp, "--", *target_args], env=env,
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=seconds * 3 + 60)
+        except subprocess.TimeoutExpired:
+            pass
+        return stat_number(read_fuzzer_stats(Path(tmp) / "default" / "fuzzer_stats").get("execs_per_sec", "0"))
+
+DELIVERY_LOG = ".fuzz_delivery.json"
+
+def delivery_rates(binary: str, corpus: str, seconds: int) -> dict:
+    file_rate = measure_execs([binary, "@@"], corpus, seconds)
+    shmem_rate = measure_execs([binary], corpus, seconds) if binary_features(binary)["shmem"] else None
+    return {"file": file_rate, "shmem": shmem_rate,
+            "speedup": shmem_rate / file_rate if shmem_rate and file_rate else None}
+
+def measure_delivery(name: str, seconds: int):
+    # exec/s of every built variant with file input and, where the binary supports it, with
+    # shared memory test cases
+    target = TARGETS[name]
+    results = measured_builds(name, target["executable"], DELIVERY_LOG, "measuring delivery of",
+                              lambda binary: delivery_rates(binary, target["corpus"], seconds))
+    print(f"{'variant':12} {'file':>10} {'shmem':>10} {'speedup':>8}")
+    for variant, result in sorted(results.items()):
+        shmem = f"{result['shmem']:.0f}" if result["shmem"] else "-"
+        speedup = f"{result['speedup']:.2f}x" if result["speedup"] else "-"
+        print(f"{variant:12} {result['file']:>10.0f} {shmem:>10} {speedup:>8}")
+
+def replay_seed(binary: str, seed: str, shmem: bool, limit: float):
+    # one run of the harness outside afl. shmem harnesses read stdin when not under afl-fuzz,
+    # the others take the file as argument
+    with open(seed, "rb") as f:
+        args = [binary] if shmem else [binary, seed]
+        return run_measured(args, timeout=limit, stdin=f if shmem else subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def startup_seconds(binary: str, shmem: bool, runs: int = 3) -> float:
+    # process start, loader and sanitizer init, measured on an empty input. the forkserver
+    # pays this once, so it is taken off every replayed exec time
+    return sorted(replay_seed(binary, os.devnull, shmem, 10)[1] for _ in range(runs))[runs // 2]
+
+def corpus_sample(corpus: str, limit: int) -> list:
+    seeds = sorted(str(p) for p in Path(corpus).rglob("*") if p.is_file())
+    step = max(1, len(seeds) / limit)
+    return [seeds[int(i * step)] for i in range(min(limit, len(seeds)))]
+
+def percentile(values: list, q: float) -> float:
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+TIMEOUTS_LOG = ".fuzz_timeouts.json"
+# afl-fuzz -t bounds, and how far above the measured tail an exec may run before it counts
+TIMEOUT_FLOOR_MS = 20
+TIMEOUT_CAP_MS = 10000
+TIMEOUT_P99_FACTOR = 5
+HANG_FACTOR = 4
+
+def calibrate_variant(binary: str, corpus: str, seeds: int) -> dict:
+    shmem = binary_features(binary)["shmem"]
+    startup = startup_seconds(binary, shmem)
+    times = []
+    timed_out = 0
+    for seed in corpus_sample(corpus, seeds):
+        ret, seconds, _ = replay_seed(binary, seed, shmem, TIMEOUT_CAP_MS / 1000)
+        if ret == -signal.SIGKILL:
+            timed_out += 1
+        else:
+            times.append(max(0.0, seconds - startup) * 1000)
+    times = times or [0.0]
+    # a generous multiple of the tail, but never tight enough to time out a seed that passed
+    timeout = max(TIMEOUT_FLOOR_MS, percentile(times, 0.99) * TIMEOUT_P99_FACTOR, max(times) * 1.5)
+    timeout = min(TIMEOUT_CAP_MS, math.ceil(timeout / 10) * 10)
+    return {
+        "seeds": len(times) + timed_out,
+        "timed_out": timed_out,
+        "startup_ms": round(startup * 1000, 2),
+        "p50_ms": round(percentile(times, 0.5), 2),
+        "p90_ms": round(percentile(times, 0.9), 2),
+        "p99_ms": round(percentile(times, 0.99), 2),
+        "max_ms": round(max(times), 2),
+        "timeout_ms": timeout,
+        "hang_ms": min(TIMEOUT_CAP_MS, timeout * HANG_FACTOR),
+    }
+
+def measured_builds(target: str, executable: str, log_name: str, what: str, measure, builds: set = None) -> dict:
+    # measure(binary) for every built variant of target, or only the given builds. kept next to
+    # the builds and only redone for a variant whose binary changed
+    path = Path(TARGETS[target]["path"])
+    log_path = path / log_name
+    try:
+        results = json.loads(log_path.read_text())
+    except (OSError, ValueError):
+        results = {}
+    changed = False
+    for build in sorted(path.glob("build_*")):
+        binary = build / executable
+        variant = build.name[len("build_"):]
+        if not binary.is_file() or (builds is not None and variant not in builds):
+            continue
+        if results.get(variant, {}).get("binary") != binary_hash(str(binary)):
+            print(f"{what} {variant}", file=sys.stderr)
+            results[variant] = {**measure(str(binary)), "binary": binary_hash(str(binary))}
+            changed = True
+    if changed:
+        log_path.write_text(json.dumps(results, indent=2, sort_keys=True))
+    return results
+
+def calibrate_timeouts(target: str, corpus: str, executable: str) -> dict:
+    # replays (a sample of) the seed corpus against every built variant
+    seeds = argv_value("calibrateseeds", 200)
+    return measured_builds(target, executable, TIMEOUTS_LOG, "calibrating timeout of",
+                           lambda binary: calibrate_variant(binary, corpus, seeds))
+
+BENCHMARK_LOG = ".fuzz_execs.json"
 
-    # Create the tmux session with the first (main) command
-    main_cmd = fmt_str.format(
-        env_args="", timeout=100, M_or_S="-M", mem_limit_str="",
-        variant="main", redqueen_str="", sand_str="", afl_args="",
-        corpus=corpus, out=out,
-        executable=f"./targets/{target}/build_nosan/{executable}"
-    )
+def benchmark_variant(binary: str, corpus: str, seconds: int) -> dict:
+    # execs/s of a short afl-fuzz run, with the test case delivery the instances will use
+    shmem = binary_features(binary)["shmem"] and "fileinput" not in sys.argv
+    return {
+        "execs_per_sec": measure_execs([binary] if shmem else [binary, "@@"], corpus, seconds),
+        "delivery": "shmem" if shmem else "file",
+        "startup_ms": round(startup_seconds(binary, shmem) * 1000, 2),
+    }
+
+def run_benchmark(target: str, corpus: str, executable: str, builds: set = None) -> dict:
+    seconds = argv_value("benchseconds", 10)
+    return measured_builds(target, executable, BENCHMARK_LOG, "benchmarking",
+                           lambda binary: benchmark_variant(binary, corpus, seconds), builds)
+
+def benchmark_report(results: dict) -> str:
+    lines = [f"{'build':16} {'execs/s':>9} {'delivery':>8} {'startup':>9}"]
+    for variant, r in sorted(results.items(), key=lambda item: -item[1]["execs_per_sec"]):
+        lines.append(f"{variant:16} {r['execs_per_sec']:>9.0f} {r['delivery']:>8} {r['startup_ms']:>7.1f}ms")
+    return "\n".join(lines)
+
+def fuzzed_builds(target: str, corpus: str, out: str, executable: str, variants) -> dict:
+    # variant -> the build whose binary its instances execute for every test case. -w and -c
+    # binaries only run on new queue entries, so they don't set an instance's exec rate
+    return {variant: instance_builds(secondary_instance(target, corpus, out, executable, variant, 0, {}))[-1]
+            for variant in variants}
 
-    cmds.append(f"tmux new-session -d -s {session_name} -n main")
-    cmds.append(f"tmux send-keys -t {session_name}:main '{main_cmd}' C-m")
+def benchmark_gate(weights: dict, results: dict, builds: dict) -> dict:
+    # minexecs=N: variants whose fuzzed binary measures below N execs/s get no instances, or with
+    # slowweight=F keep F times their weight
+    threshold = argv_value("minexecs", 0.0)
+    factor = argv_value("slowweight", 0.0)
+    gated = dict(weights)
+    for variant in weights:
+        rate = results.get(builds.get(variant), {}).get("execs_per_sec")
+        if rate is not None and rate < threshold:
+            print(f"{variant}: build_{builds[variant]} runs {rate:.0f} execs/s, below {threshold:.0f}, "
+                  f"{'weight x' + str(factor) if factor else 'skipped'}", file=sys.stderr)
+            if factor:
+                gated[variant] *= factor
+            else:
+                del gated[variant]
+    return gated
+
+def instance_builds(spec: dict) -> list:
+    # the builds an instance's binaries come from, -w and -c included, the fuzzed one last
+    return [m.group(1) for m in map(re.compile(r"/build_([^/]+)/").search, spec["args"]) if m]
 
-    # Generate secondary fuzzer commands
+def apply_timeouts(spec: dict, calibration: dict):
+    # -t and AFL_HANG_TMOUT from the slowest calibrated binary the instance runs (-w, -c
+    # included). a "+" makes afl skip seeds that time out instead of refusing to start
+    spec["calibration"] = calibration
+    entries = [calibration[v] for v in instance_builds(spec) if v in calibration]
+    if not entries:
+        return
+    args = spec["args"]
+    timeout = max(e["timeout_ms"] for e in entries)
+    args[args.index("-t") + 1] = f"{timeout}+" if any(e["timed_out"] for e in entries) else str(timeout)
+    spec["env"]["AFL_HANG_TMOUT"] = str(max(e["hang_ms"] for e in entries))
 
+def timeout_report(calibration: dict) -> str:
+    lines = [f"{'variant':12} {'startup':>8} {'p50':>8} {'p99':>8} {'max':>8} {'-t':>6} {'hang':>6}"]
+    for variant, e in sorted(calibration.items()):
+        lines.append(f"{variant:12} {e['startup_ms']:>8.1f} {e['p50_ms']:>8.1f} {e['p99_ms']:>8.1f} "
+                     f"{e['max_ms']:>8.1f} {e['timeout_ms']:>6} {e['hang_ms']:>6}")
+    return "\n".join(lines)
+
+def instance_specs(target, corpus, out, executable):
+    specs = [main_instance(target, corpus, out, executable)]
+    # one instance per cpu we're allowed to use, the main instance included
+    weights = variant_weights()
+    if argv_value("minexecs", 0.0):
+        builds = fuzzed_builds(target, corpus, out, executable, weights)
+        weights = benchmark_gate(weights, run_benchmark(target, corpus, executable, set(builds.values())), builds)
+    counts = allocate_instances(argv_value("instances", available_cpus()) - 1, weights)
     for variant in VARIANTS:
-        num_procs = 1
+        num_procs = counts.get(variant, 0)
         for i in range(num_procs):
-            env_args = " "
-            afl_args = ""
-            sand_str = ""
-            redqueen_str = ""
-
-            if "sand" in variant:
-                executable_path = f"./targets/{target}/build_nosan/{executable}"
-                #-w ./targets/{target}/build_sand_msan/{executable}
-                sand_str = f" -w ./targets/{target}/build_sand_asan/{executable} -w ./targets/{target}/build_sand_ubsan/{executable}  "
-            elif "redqueen" in variant:
-                executable_path = f"./targets/{target}/build_nosan/{executable}"
-                redqueen_str = f"-c ./targets/{target}/build_redqueen/{executable}"
-            else:
-                executable_path = f"./targets/{target}/build_{variant}/{executable}"
-
-
-
-            if random.randint(1,10) == 1:
-                afl_args += " -L 0 "
-            if random.randint(1,10) == 1:
-                afl_args += " -Z "
-            #if random.randint(1,3) == 1:
-            #    afl_args += " -P explore"
-            #elif random.randint(1,2) == 1:
-            #    afl_args +=  " -P exploit "
-
-            #if random.randint(1, 8) == 1:
-            #    afl_args += " -p explore "
-            #elif random.randint(1, 7) == 1:
-            #    afl_args += " -p fast "
-            #elif random.randint(1, 6) == 1:
-            #    afl_args += " -p exploit "
-            #elif random.randint(1, 5) == 1:
-            #    afl_args += " -p seek "
-            #elif random.randint(1, 4) == 1:
-            #    afl_args += " -p rare "
-            #elif random.randint(1, 3) == 1:
-            #    afl_args += " -p mmopt "
-            #elif random.randint(1, 2) == 1:
-            #    afl_args += " -p coe "
-
-            #if random.randint(1,2) == 1:
-            #    env_args += "AFL_DISABLE_TRIM=1 "
-            #if random.randint(1,2) == 1:
-            #    env_args += "AFL_KEEP_TIMEOUTS=1 "
-            #if random.randint(1,2) == 1:
-            #    env_args += "AFL_EXPAND_HAVOC_NOW=1 "
-
-            if "redqueen" in variant:
-                if random.randint(1,2) == 1:
-                    afl_args += " -l 2 "
-                elif random.randint(1,2) == 1:
-                    afl_args += " -l 2AT "
-                elif random.randint(1,2) == 1:
-                    afl_args += " -l 3 "
-
-            window_name = variant + str(i)
-            afl_cmd = fmt_str.format(
-                env_args=env_args, timeout=10000, mem_limit_str="",
-                M_or_S="-S", variant=window_name, redqueen_str=redqueen_str,
-                sand_str=sand_str, afl_args=afl_args, corpus=corpus, out=out,
-                executable=executable_path
-            )
+            specs.append(secondary_instance(target, corpus, out, executable, variant, i))
+    for spec in specs:
+        apply_delivery(spec)
+    print(delivery_report(specs), file=sys.stderr)
+    if "nocalibrate" not in sys.argv:
+        calibration = calibrate_timeouts(target, corpus, executable)
+        for spec in specs:
+            apply_timeouts(spec, calibration)
+        print(timeout_report(calibration), file=sys.stderr)
+    if "nopin" not in sys.argv:
+        pin_instances(specs)
+        print(placement_report(specs), file=sys.stderr)
+    if "noscratch" not in sys.argv:
+        assign_scratch(specs, scratch_root())
+    if "groups" in sys.argv:
+        group_instances(specs, out, argv_value("groupsize", 32))
+    return specs
 
+def gen_commands(target, corpus, out, executable):
+    session_name = "afl-fuzzing"
+
+    cmds = []
+    specs = instance_specs(target, corpus, out, executable)
+    scratch_dirs = [spec["scratch"] for spec in specs if "scratch" in spec]
+    if scratch_dirs:
+        cmds.append(f"mkdir -p {' '.join(scratch_dirs)}")
+    for spec in specs:
+        env_args = " ".join(f"{k}={v}" for k, v in spec["env"].items())
+        if "placement" in spec:
+            # -b and AFL_NO_AFFINITY are mutually exclusive
+            env_args = f"env -u AFL_NO_AFFINITY {env_args}"
+        afl_cmd = f"{env_args} {' '.join(spec['args'])}"
+        if spec["name"] == "main":
+            # Create the tmux session with the first (main) command
+            cmds.append(f"tmux new-session -d -s {session_name} -n main")
+        else:
             # Create new window and send command
-            cmds.append(f"tmux new-window -t {session_name} -n {window_name}")
-            cmds.append(f"tmux send-keys -t {session_name}:{window_name} '{afl_cmd}' C-m")
+            cmds.append(f"tmux new-window -t {session_name} -n {spec['name']}")
+        cmds.append(f"tmux send-keys -t {session_name}:{spec['name']} '{afl_cmd}' C-m")
+
+    if sync_dirs(specs):
+        relay = f"{sys.executable} {Path(__file__).resolve()} relay {argv_value('relay', 60.0)} {' '.join(sync_dirs(specs))}"
+        cmds.append(f"tmux new-window -t {session_name} -n relay")
+        cmds.append(f"tmux send-keys -t {session_name}:relay '{relay}' C-m")
 
-    # Add cleanup command in its own window
+    if argv_value("syncto", ""):
+        node_sync = (f"{sys.executable} {Path(__file__).resolve()} nodesync {argv_value('syncevery', 300.0)} {out} "
+                     f"syncto={argv_value('syncto', '')} node={argv_value('node', socket.gethostname())} "
+                     f"{' '.join(sync_dirs(specs) or [out])}")
+        cmds.append(f"tmux new-window -t {session_name} -n nodesync")
+        cmds.append(f"tmux send-keys -t {session_name}:nodesync '{node_sync}' C-m")
+
+    # Add cleanup command in its own window. without the supervisor nobody knows when a file is
+    # no longer in use, so only remove what has been sitting in a scratch dir for a minute
     cmds.append(f"tmux new-window -t {session_name} -n cleanup")
-    cmds.append(f"tmux send-keys -t {session_name}:cleanup 'while true; do rm -rf /tmp/fuzz_model_*; sleep 60; done' C-m")
+    if scratch_dirs:
+        cmds.append(f"tmux send-keys -t {session_name}:cleanup 'while true; do find {scratch_root()} -mindepth 2 "
+                    f"-type f ! -name .cur_input\\* -mmin +1 -delete; sleep 10; done' C-m")
+    else:
+        # no scratch dirs, the harness drops its temp models straight into /tmp
+        cmds.append(f"tmux send-keys -t {session_name}:cleanup 'while true; do find {SHARED_TMP} -maxdepth 1 "
+                    f"-name {SHARED_TMP_PREFIX}\\* -mmin +1 -exec rm -rf {{}} +; sleep 60; done' C-m")
 
     # Add final instruction
     cmds.append(f"echo 'Fuzzing session started. Connect with: tmux attach-session -t {session_name}'")
@@ -334,6 +1467,987 @@ def gen_commands(target, corpus, out, executable):
     return "\nsleep .1\n".join(cmds)
 
 
+def log(msg: str):
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+
+def read_fuzzer_stats(path) -> dict:
+    # afl's fuzzer_stats is "key    : value" per line
+    stats = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, sep, value = line.partition(":")
+                if sep:
+                    stats[key.strip()] = value.strip()
+    except OSError:
+        pass
+    return stats
+
+class Instance:
+    # one supervised afl-fuzz process and its restart bookkeeping
+
+    def __init__(self, spec: dict, out: str):
+        self.spec = spec
+        self.name = spec["name"]
+        self.out = out
+        self.proc = None
+        self.started = 0.0
+        self.restarts = 0
+        self.last_execs = -1
+        self.last_progress = 0.0
+        self.progressed = False
+        self.retired = False
+        # portfolio mode: local paths found when the current options were last measured
+        self.options_found = None
+        self.options_since = 0.0
+
+    async def start(self):
+        env = os.environ.copy()
+        # afl-fuzz has no tty here, and a restarted instance has to pick its queue back up
+        env.update({"AFL_NO_UI": "1", "AFL_AUTORESUME": "1"})
+        env.update(self.spec["env"])
+        if "placement" in self.spec:
+            # -b and AFL_NO_AFFINITY are mutually exclusive
+            env.pop("AFL_NO_AFFINITY", None)
+        log_file = open(Path(self.out) / f"{self.name}.log", "ab")
+        self.proc = await asyncio.create_subprocess_exec(*self.spec["args"], env=env, stdin=subprocess.DEVNULL,
+                                                         stdout=log_file, stderr=subprocess.STDOUT,
+                                                         start_new_session=True)
+        log_file.close()
+        self.started = self.last_progress = time.monotonic()
+        self.last_execs = -1
+        self.progressed = False
+        log(f"{self.name}: started pid {self.proc.pid}")
+
+    def stats(self) -> dict:
+        return read_fuzzer_stats(Path(self.spec.get("sync_dir", self.out)) / self.name / "fuzzer_stats")
+
+    def running(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    def signal(self, sig):
+        if self.running():
+            try:
+                os.killpg(self.proc.pid, sig)
+            except ProcessLookupError:
+                pass
+
+# one unique crash is worth this many new paths when scoring variants
+CRASH_REWARD = 10
+
+class VariantBandit:
+    # UCB1 over variants, where a variant's reward is what its instances found per cpu hour.
+    # rewards are exponentially decayed so a variant that dried up stops living off its past
+
+    def __init__(self, variants, decay: float = 0.5, exploration: float = 1.0):
+        self.mean = {v: 0.0 for v in variants}
+        self.pulls = {v: 0 for v in variants}
+        self.decay = decay
+        self.exploration = exploration
+
+    def update(self, variant: str, reward: float):
+        if self.pulls[variant]:
+            self.mean[variant] = self.decay * self.mean[variant] + (1 - self.decay) * reward
+        else:
+            self.mean[variant] = reward
+        self.pulls[variant] += 1
+
+    def scores(self) -> dict:
+        total = sum(self.pulls.values())
+        # normalize the bonus to the reward scale, which varies wildly between targets
+        scale = max(self.mean.values(), default=0) or 1.0
+        return {v: float("inf") if not self.pulls[v] else
+                self.mean[v] + self.exploration * scale * math.sqrt(math.log(total) / self.pulls[v])
+                for v in self.mean}
+
+class OptionPortfolio:
+    # decayed mean coverage gain rate per option combination, and epsilon-greedy choice of the
+    # next combination for an instance being rotated
+
+    def __init__(self, epsilon: float = 0.25, decay: float = 0.5):
+        self.epsilon = epsilon
+        self.decay = decay
+        self.rate = {}
+        self.options = {}
+
+    def record(self, options: dict, rate: float):
+        key = options_key(options)
+        self.options[key] = options
+        old = self.rate.get(key)
+        self.rate[key] = rate if old is None else self.decay * old + (1 - self.decay) * rate
+
+    def choose(self, variant: str, current: dict) -> dict:
+        dims = set(option_dimensions(variant))
+        known = [k for k in self.rate if set(self.options[k]) == dims and k != options_key(current)]
+        if not known or random.random() < self.epsilon:
+            return random_options(variant)
+        return dict(self.options[max(known, key=lambda k: self.rate[k])])
+
+IN_CREATE = 0x100
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+
+def exec_timeout_seconds(spec: dict) -> float:
+    # afl-fuzz -t is in milliseconds and may carry a "+" suffix; afl's default is 1000
+    args = spec["args"]
+    ms = int(re.match(r"\d+", args[args.index("-t") + 1]).group()) if "-t" in args else 1000
+    return ms / 1000
+
+SHARED_TMP = "/tmp"
+SHARED_TMP_PREFIX = "fuzz_model_"
+
+def sweep_shared_tmp(max_age: float) -> int:
+    # harness temp models of instances without a scratch dir, removed once nothing can still be using them
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in Path(SHARED_TMP).glob(SHARED_TMP_PREFIX + "*"):
+        try:
+            if path.lstat().st_mtime < cutoff:
+                if path.is_dir() and not path.is_symlink():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+class ScratchSweeper:
+    # owns the per-instance scratch dirs: a tmpfs mount with a size cap each when we are root
+    # (a plain dir on the shared tmpfs with a soft cap otherwise), inotify driven cleanup and
+    # churn accounting. a file is only removed once it is older than the instance's exec
+    # timeout, at which point the exec that wrote it is over, so cleanup can't race a test case
+
+    def __init__(self, size_mb: int):
+        self.size = size_mb * 2**20
+        self.mounted = set()
+        self.dirs = set()
+        self.churn = {}
+        self.over_quota = set()
+        self.watches = {}
+        self.pending = set()
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def setup(self, inst):
+        scratch = Path(inst.spec["scratch"])
+        scratch.mkdir(parents=True, exist_ok=True)
+        self.dirs.add(str(scratch))
+        if os.geteuid() == 0 and not os.path.ismount(scratch):
+            opts = f"size={self.size // 2**20}m,mode=1777"
+            if inst.spec["args"][0] == "numactl":
+                opts += f",mpol=bind:{inst.spec['placement']['node']}"
+            if subprocess.run(["mount", "-t", "tmpfs", "-o", opts, "tmpfs", str(scratch)]).returncode == 0:
+                self.mounted.add(str(scratch))
+        self.churn.setdefault(inst.name, {"files": 0, "bytes": 0})
+        if self.fd >= 0:
+            wd = self.libc.inotify_add_watch(self.fd, str(scratch).encode(), IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd >= 0:
+                self.watches[wd] = inst
+
+    def start(self, loop):
+        if self.fd >= 0:
+            loop.add_reader(self.fd, self.on_events, loop)
+
+    def on_events(self, loop):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+            pos += 16 + length
+            inst = self.watches.get(wd)
+            if inst and inst.name not in self.pending:
+                # sweep once the exec that produced this file has certainly finished
+                self.pending.add(inst.name)
+                loop.call_later(exec_timeout_seconds(inst.spec) + 0.1, self.sweep, inst)
+
+    def sweep(self, inst):
+        self.pending.discard(inst.name)
+        scratch = inst.spec["scratch"]
+        cutoff = time.time() - exec_timeout_seconds(inst.spec)
+        churn = self.churn[inst.name]
+        used = 0
+        for root, dirs, files in os.walk(scratch, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith(".cur_input"):
+                    continue
+                try:
+                    st = os.lstat(path)
+                    if st.st_mtime < cutoff:
+                        os.unlink(path)
+                        churn["files"] += 1
+                        churn["bytes"] += st.st_size
+                    else:
+                        used += st.st_size
+                except FileNotFoundError:
+                    pass
+            if root != scratch:
+                # a dir the harness just made (mkdtemp) may not have anything in it yet
+                try:
+                    if os.lstat(root).st_mtime < cutoff:
+                        os.rmdir(root)
+                except OSError:
+                    pass
+        if scratch not in self.mounted and used > self.size and inst.name not in self.over_quota:
+            log(f"{inst.name}: scratch dir holds {used >> 20} MB of live files, over its {self.size >> 20} MB quota")
+            self.over_quota.add(inst.name)
+        elif used <= self.size:
+            self.over_quota.discard(inst.name)
+
+    def teardown(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+        for scratch in self.mounted:
+            subprocess.run(["umount", scratch])
+        for scratch in self.dirs:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+class Checkpointer:
+    # ram backed output dir: afl works in a tmpfs copy of out/ and this mirrors it to disk every so
+    # often. queue, crash and hang entries never change once written, so a pass only copies files
+    # that are new or whose size/mtime moved (fuzzer_stats, plot_data, .synced markers, logs)
+
+    def __init__(self, ram: str, disk: str, interval: float):
+        self.ram = Path(ram)
+        self.disk = Path(disk)
+        self.interval = interval
+        self.seen = {}
+
+    def files(self, top: Path):
+        for root, dirs, files in os.walk(top):
+            for name in files:
+                if name != ".cur_input" and not name.endswith(".ckpt"):
+                    yield Path(root, name).relative_to(top)
+
+    def copy(self, src: Path, dst: Path):
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(dst.name + ".ckpt")
+        if src.is_symlink():
+            tmp.unlink(missing_ok=True)
+            os.symlink(os.readlink(src), tmp)
+        else:
+            shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+
+    def restore(self):
+        # rebuild the tmpfs layout from the last checkpoint so AFL_AUTORESUME picks up where the
+        # previous run stopped. anything still in ram (supervisor restart without a reboot) wins
+        self.ram.mkdir(parents=True, exist_ok=True)
+        restored = set()
+        if self.disk.is_dir():
+            for rel in self.files(self.disk):
+                if not os.path.lexists(self.ram / rel):
+                    self.copy(self.disk / rel, self.ram / rel)
+                    restored.add(rel)
+        # only what is already on disk counts as seen: files a killed supervisor never got to
+        # checkpoint will not change again, so the next pass must pick them up now
+        for rel in self.files(self.ram):
+            st = (self.ram / rel).lstat()
+            try:
+                on_disk = (self.disk / rel).lstat()
+            except FileNotFoundError:
+                continue
+            if rel in restored or (on_disk.st_size, on_disk.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                self.seen[rel] = (st.st_size, st.st_mtime_ns)
+        log(f"restored {len(restored)} files from {self.disk} into {self.ram}")
+
+    def checkpoint(self):
+        start = time.monotonic()
+        copied = size = 0
+        for rel in self.files(self.ram):
+            try:
+                st = (self.ram / rel).lstat()
+                if self.seen.get(rel) == (st.st_size, st.st_mtime_ns):
+                    continue
+                self.copy(self.ram / rel, self.disk / rel)
+            except FileNotFoundError:
+                # afl renames and deletes as it goes, the next pass will see the result
+                continue
+            self.seen[rel] = (st.st_size, st.st_mtime_ns)
+            copied += 1
+            size += st.st_size
+        log(f"checkpoint: {copied} files, {size >> 10} KB to {self.disk} in {time.monotonic() - start:.1f}s")
+
+    async def run(self, stopping: asyncio.Event):
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self.checkpoint)
+        await asyncio.to_thread(self.checkpoint)
+
+class QueueWriter:
+    # a pseudo afl instance: entries go into <instance_dir>/queue as id:NNNNNN, which every
+    # afl-fuzz sharing the sync dir imports like another fuzzer's finds. contents already in
+    # the queue are dropped, and ids carry on from what is there after a restart
+
+    def __init__(self, instance_dir):
+        self.queue = Path(instance_dir) / "queue"
+        self.queue.mkdir(parents=True, exist_ok=True)
+        self.hashes = set()
+        self.next_id = 0
+        for entry in os.scandir(self.queue):
+            m = re.match(r"id:(\d+)", entry.name)
+            if m:
+                self.next_id = max(self.next_id, int(m.group(1)) + 1)
+                self.hashes.add(hashlib.sha1(Path(entry.path).read_bytes()).digest())
+
+    def add(self, data: bytes, origin: str) -> bool:
+        digest = hashlib.sha1(data).digest()
+        if digest in self.hashes:
+            return False
+        self.hashes.add(digest)
+        name = f"id:{self.next_id:06d},orig:{origin}"
+        # afl must never see a partially written entry
+        tmp = self.queue.parent / f".{self.next_id:06d}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, self.queue / name)
+        self.next_id += 1
+        return True
+
+class QueueScanner:
+    # incremental scan of the instance queues in sync dirs: yields each entry an instance found
+    # itself once, in id order. queues whose mtime didn't move are skipped; ",sync:" entries were
+    # imported from a peer and ",orig:" ones were written by a QueueWriter
+
+    def __init__(self, skip: set):
+        self.skip = skip
+        self.cursors = {}
+        self.mtimes = {}
+
+    def finds(self, sync_dir: str):
+        for inst in os.scandir(sync_dir):
+            if inst.name in self.skip or inst.name.startswith(".") or not inst.is_dir():
+                continue
+            queue = Path(inst.path) / "queue"
+            try:
+                mtime = queue.stat().st_mtime_ns
+            except OSError:
+                continue
+            if self.mtimes.get(queue) == mtime:
+                continue
+            self.mtimes[queue] = mtime
+            last = self.cursors.get(queue, -1)
+            new = []
+            for entry in os.scandir(queue):
+                m = re.match(r"id:(\d+)", entry.name)
+                if m and int(m.group(1)) > last:
+                    new.append((int(m.group(1)), entry))
+            for n, entry in sorted(new, key=lambda e: e[0]):
+                self.cursors[queue] = n
+                if ",sync:" in entry.name or ",orig:" in entry.name:
+                    continue
+                try:
+                    yield inst.name, n, Path(entry.path).read_bytes()
+                except OSError:
+                    pass
+
+class SyncRelay:
+    # forwards entries between the sync dirs of a grouped topology. only what an instance found
+    # itself is forwarded: seeds are in every group already and ",sync:" entries were imported
+    # from a peer, which is either in the same group or got them from this relay. each distinct
+    # content is forwarded once, to every other group, so the cost is linear in new finds
+
+    def __init__(self, sync_dirs: list):
+        self.writers = {d: QueueWriter(Path(d) / RELAY_NAME) for d in sync_dirs}
+        self.seen = set().union(*(w.hashes for w in self.writers.values()))
+        self.scanner = QueueScanner({RELAY_NAME})
+        self.forwarded = 0
+
+    def poll(self) -> int:
+        forwarded = 0
+        for sync_dir in self.writers:
+            for name, n, data in self.scanner.finds(sync_dir):
+                digest = hashlib.sha1(data).digest()
+                if digest in self.seen:
+                    continue
+                self.seen.add(digest)
+                for other, writer in self.writers.items():
+                    if other != sync_dir:
+                        writer.add(data, f"{name}_{n:06d}")
+                forwarded += 1
+        self.forwarded += forwarded
+        return forwarded
+
+    async def run(self, stopping: asyncio.Event, interval: float):
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                forwarded = await asyncio.to_thread(self.poll)
+                log(f"relay: forwarded {forwarded} new entries between {len(self.writers)} groups")
+
+def run_relay(interval: float, sync_dirs: list):
+    # standalone relay for the tmux launcher
+    relay = SyncRelay(sync_dirs)
+    while True:
+        forwarded = relay.poll()
+        log(f"relay: forwarded {forwarded} new entries between {len(sync_dirs)} groups")
+        time.sleep(interval)
+
+SYNC_NAME = "sync"
+
+class Transport(ABC):
+    # how nodes of a multi-host campaign exchange queue entries. every node publishes its own
+    # finds under its name, peers read them back in publication order from an offset they keep
+
+    @abstractmethod
+    def publish(self, node: str, entries: list):
+        # entries are (sha1 hex, bytes); already published contents must be skipped
+        ...
+
+    @abstractmethod
+    def peers(self, node: str) -> list:
+        ...
+
+    @abstractmethod
+    def fetch(self, peer: str, offset: int) -> tuple:
+        # returns ([(sha1 hex, bytes)], next offset)
+        ...
+
+class SharedDirTransport(Transport):
+    # <root>/<node>/objects/<sha1> plus an append only index of hashes. works on anything every
+    # node can mount (nfs, a synced dir), or on a local dir to test with several nodes on one box
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def publish(self, node: str, entries: list):
+        objects = self.root / node / "objects"
+        objects.mkdir(parents=True, exist_ok=True)
+        added = []
+        for digest, data in entries:
+            if (objects / digest).exists():
+                continue
+            tmp = objects / f".{digest}.tmp"
+            tmp.write_bytes(data)
+            os.replace(tmp, objects / digest)
+            added.append(digest)
+        if added:
+            # a reader must only see an index line once its object is in place
+            with open(self.root / node / "index", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write("".join(f"{digest}\n" for digest in added))
+
+    def peers(self, node: str) -> list:
+        try:
+            return sorted(e.name for e in os.scandir(self.root) if e.is_dir() and e.name != node)
+        except OSError:
+            return []
+
+    def fetch(self, peer: str, offset: int) -> tuple:
+        try:
+            with open(self.root / peer / "index", "rb") as f:
+                f.seek(offset)
+                chunk = f.read()
+        except OSError:
+            return [], offset
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        entries = []
+        for digest in complete.decode().split():
+            try:
+                entries.append((digest, (self.root / peer / "objects" / digest).read_bytes()))
+            except OSError:
+                pass
+        return entries, offset + len(complete)
+
+# scheme -> transport class; anything without a scheme is a shared directory
+TRANSPORTS = {"file": SharedDirTransport}
+
+def make_transport(url: str) -> Transport:
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        return SharedDirTransport(url)
+    if scheme not in TRANSPORTS:
+        raise ValueError(f"unknown sync transport {scheme}://")
+    return TRANSPORTS[scheme](rest)
+
+class NodeSync:
+    # multi-host campaigns: exports what this node's instances found themselves, and imports
+    # what peers found into a "sync" pseudo-instance in every local sync dir, where afl-fuzz
+    # picks it up like any other fuzzer's queue. contents are compared by hash both ways, so
+    # nothing crosses the transport twice and imports are never exported back
+
+    def __init__(self, node: str, transport: Transport, sync_dirs: list, state_path: str):
+        self.node = node
+        self.transport = transport
+        self.sync_dirs = sync_dirs
+        self.writers = [QueueWriter(Path(d) / SYNC_NAME) for d in sync_dirs]
+        self.known = set().union(*(w.hashes for w in self.writers))
+        self.state_path = Path(state_path)
+        try:
+            self.offsets = json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            self.offsets = {}
+        self.scanner = QueueScanner({SYNC_NAME, RELAY_NAME})
+
+    def poll(self) -> tuple:
+        exported = []
+        for sync_dir in self.sync_dirs:
+            for _, _, data in self.scanner.finds(sync_dir):
+                digest = hashlib.sha1(data).hexdigest()
+                if bytes.fromhex(digest) not in self.known:
+                    self.known.add(bytes.fromhex(digest))
+                    exported.append((digest, data))
+        self.transport.publish(self.node, exported)
+
+        imported = 0
+        for peer in self.transport.peers(self.node):
+            entries, self.offsets[peer] = self.transport.fetch(peer, self.offsets.get(peer, 0))
+            for digest, data in entries:
+                if bytes.fromhex(digest) in self.known:
+                    continue
+                self.known.add(bytes.fromhex(digest))
+                for writer in self.writers:
+                    writer.add(data, f"{peer}_{digest[:12]}")
+                imported += 1
+        self.state_path.write_text(json.dumps(self.offsets))
+        return len(exported), imported
+
+    def report(self, counts: tuple) -> str:
+        return f"node sync: exported {counts[0]}, imported {counts[1]} entries as {self.node}"
+
+    async def run(self, stopping: asyncio.Event, interval: float):
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                log(self.report(await asyncio.to_thread(self.poll)))
+
+def run_node_sync(node_sync: NodeSync, interval: float):
+    # standalone daemon for the tmux launcher
+    while True:
+        log(node_sync.report(node_sync.poll()))
+        time.sleep(interval)
+
+def node_sync_for(specs: list, out: str):
+    # syncto=<transport> turns on multi-host sync, node= names this host to its peers
+    if not argv_value("syncto", ""):
+        return None
+    return NodeSync(argv_value("node", socket.gethostname()), make_transport(argv_value("syncto", "")),
+                    sync_dirs(specs) or [out], f"{out}/.node_sync.json")
+
+class Supervisor:
+    # runs afl-fuzz instances as children, restarts the ones that die or stop making progress
+    # with exponential backoff, and takes everything down on SIGINT/SIGTERM
+
+    def __init__(self, specs: list, out: str, stall_seconds: float, check_seconds: float = 30, port: int = 0,
+                 make_spec=None, epoch_seconds: float = 0, portfolio_seconds: float = 0, checkpointer=None,
+                 node_sync=None):
+        self.out = out
+        self.checkpointer = checkpointer
+        self.node_sync = node_sync
+        self.relay = SyncRelay(sync_dirs(specs)) if sync_dirs(specs) else None
+        self.instances = [Instance(spec, out) for spec in specs]
+        self.stats = CampaignStats(out)
+        self.port = port
+        # adaptive mode: every epoch move a core from the least to the most productive variant
+        self.make_spec = make_spec
+        self.epoch_seconds = epoch_seconds
+        self.bandit = VariantBandit(sorted({i.spec["variant"] for i in self.instances} - {"main"}))
+        # portfolio mode: every so often restart the weakest instance of a variant with options
+        # that have measured better
+        self.portfolio_seconds = portfolio_seconds
+        self.portfolio = OptionPortfolio()
+        self.scratch = ScratchSweeper(argv_value("scratchmb", 512))
+        self.stall_seconds = stall_seconds
+        self.check_seconds = check_seconds
+        self.stopping = asyncio.Event()
+        self.tasks = []
+
+    async def keep_alive(self, inst: Instance):
+        while not self.stopping.is_set() and not inst.retired:
+            await inst.start()
+            ret = await inst.proc.wait()
+            if self.stopping.is_set() or inst.retired:
+                break
+            # a long healthy run earns a fresh backoff
+            if time.monotonic() - inst.started > 600:
+                inst.restarts = 0
+            delay = min(2 ** inst.restarts, 300)
+            inst.restarts += 1
+            log(f"{inst.name}: exited with {ret}, restarting in {delay}s")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def check_health(self):
+        now = time.monotonic()
+        total = 0.0
+        for inst in self.instances:
+            if not inst.running():
+                continue
+            stats = inst.stats()
+            execs = int(stats.get("execs_done", 0))
+            total += float(stats.get("execs_per_sec", 0))
+            # the first reading may be what the previous run left in fuzzer_stats, and execs_done
+            # stands still while afl replays its queue on startup, which can take longer than
+            # the stall timeout. only an instance that has fuzzed since its start can stall
+            if execs != inst.last_execs:
+                inst.progressed = inst.last_execs >= 0
+                inst.last_execs = execs
+                inst.last_progress = now
+            elif inst.progressed and now - inst.last_progress > self.stall_seconds:
+                log(f"{inst.name}: no progress for {now - inst.last_progress:.0f}s, killing")
+                inst.signal(signal.SIGKILL)
+        alive = sum(inst.running() for inst in self.instances)
+        log(f"{alive}/{len(self.instances)} instances running, {total:.0f} execs/s")
+        self.stats.refresh()
+
+        if self.scratch.churn:
+            # catch anything inotify didn't tell us about
+            for inst in self.active():
+                if "scratch" in inst.spec:
+                    self.scratch.sweep(inst)
+            churn = self.scratch.churn
+            log(f"scratch churn: {sum(c['files'] for c in churn.values())} files, "
+                f"{sum(c['bytes'] for c in churn.values()) >> 20} MB removed")
+            (Path(self.out) / "scratch_churn.json").write_text(json.dumps(churn, indent=2, sort_keys=True))
+        unscratched = [inst for inst in self.active() if "scratch" not in inst.spec]
+        if unscratched:
+            sweep_shared_tmp(max(60.0, max(exec_timeout_seconds(inst.spec) for inst in unscratched)))
+
+    async def monitor(self):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.check_seconds)
+            except asyncio.TimeoutError:
+                self.check_health()
+
+    def add(self, inst: Instance):
+        if "scratch" in inst.spec:
+            self.scratch.setup(inst)
+        self.instances.append(inst)
+        self.tasks.append(asyncio.create_task(self.keep_alive(inst)))
+
+    async def stop_instance(self, inst: Instance, grace: float = 10):
+        inst.retired = True
+        if not inst.running():
+            return
+        inst.signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(inst.proc.wait(), grace)
+        except asyncio.TimeoutError:
+            inst.signal(signal.SIGKILL)
+            await inst.proc.wait()
+
+    def active(self, variant: str = None) -> list:
+        return [i for i in self.instances if not i.retired and variant in (None, i.spec["variant"])]
+
+    def scheduler_log(self, entry: dict):
+        entry["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(Path(self.out) / "scheduler.log", "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def variant_yield(self) -> dict:
+        # new local paths plus weighted unique crashes, summed over every instance a variant
+        # ever had (retired ones keep their counts, they just stop growing)
+        self.stats.refresh()
+        found = {}
+        for values in self.stats.snapshot()["instances"].values():
+            paths = values["corpus_found"] or values["corpus_count"]
+            found[values["variant"]] = found.get(values["variant"], 0) + paths + CRASH_REWARD * values["saved_crashes"]
+        return found
+
+    async def adapt(self):
+        previous = self.variant_yield()
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.epoch_seconds)
+                return
+            except asyncio.TimeoutError:
+                pass
+            current = self.variant_yield()
+            hours = self.epoch_seconds / 3600
+            rewards = {}
+            for variant in self.bandit.mean:
+                n = len(self.active(variant))
+                if n:
+                    rewards[variant] = (current.get(variant, 0) - previous.get(variant, 0)) / (n * hours)
+                    self.bandit.update(variant, rewards[variant])
+            previous = current
+            scores = self.bandit.scores()
+            # only take from variants that keep at least one instance, so nothing stops being measured
+            donors = [v for v in scores if len(self.active(v)) > 1]
+            if not donors:
+                continue
+            worst = min(donors, key=lambda v: scores[v])
+            best = max(scores, key=lambda v: scores[v])
+            decision = {"rewards": rewards, "scores": {v: round(x, 3) for v, x in scores.items() if x != float("inf")}}
+            # demand a clear margin so near-equal variants don't trade a core back and forth
+            if best == worst or scores[best] <= scores[worst] * 1.25:
+                self.scheduler_log(dict(decision, action="keep"))
+                continue
+            victim = max(self.active(worst), key=lambda i: i.started)
+            await self.stop_instance(victim)
+            index = 1 + max((int(m.group()) for i in self.instances
+                             if i.spec["variant"] == best and (m := re.search(r"\d+$", i.name))), default=-1)
+            spec = self.make_spec(best, index)
+            self.respawn(victim, spec)
+            log(f"adaptive: moved a core from {worst} ({victim.name}) to {best} ({spec['name']})")
+            self.scheduler_log(dict(decision, action="move", stopped=victim.name, started=spec["name"],
+                                    source=worst, destination=best))
+
+    def respawn(self, old: Instance, spec: dict):
+        if "placement" in old.spec:
+            pin_instance(spec, old.spec["placement"], old.spec["args"][0] == "numactl")
+        if "scratch" in old.spec:
+            assign_scratch([spec], Path(old.spec["scratch"]).parent)
+        if "sync_dir" in old.spec:
+            set_sync_dir(spec, old.spec["sync_dir"])
+        apply_delivery(spec)
+        if "calibration" in old.spec:
+            apply_timeouts(spec, old.spec["calibration"])
+        self.add(Instance(spec, self.out))
+
+    async def rotate_options(self):
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.portfolio_seconds)
+                return
+            except asyncio.TimeoutError:
+                pass
+            self.stats.refresh()
+            values = self.stats.snapshot()["instances"]
+            now = time.monotonic()
+            rates = {}
+            for inst in self.active():
+                if not inst.spec.get("options") or inst.name not in values:
+                    continue
+                found = values[inst.name]["corpus_found"] or values[inst.name]["corpus_count"]
+                if inst.options_found is not None:
+                    rates[inst.name] = (found - inst.options_found) / ((now - inst.options_since) / 3600)
+                    self.portfolio.record(inst.spec["options"], rates[inst.name])
+                inst.options_found = found
+                inst.options_since = now
+
+            # instances only compete with their own variant, sanitizers are just slower
+            for variant in sorted({i.spec["variant"] for i in self.active()}):
+                measured = sorted(((rates[i.name], i) for i in self.active(variant) if i.name in rates),
+                                  key=lambda m: m[0])
+                if len(measured) < 2:
+                    continue
+                median = measured[len(measured) // 2][0]
+                rate, worst = measured[0]
+                if rate >= 0.5 * median:
+                    continue
+                options = self.portfolio.choose(variant, worst.spec["options"])
+                # same -S name, so AFL_AUTORESUME picks the instance's queue back up
+                index = int(re.search(r"\d+$", worst.name).group())
+                await self.stop_instance(worst)
+                self.respawn(worst, self.make_spec(variant, index, options))
+                log(f"portfolio: restarting {worst.name} ({rate:.1f} paths/h, median {median:.1f}) "
+                    f"with {options_key(options)}")
+                with open(Path(self.out) / "portfolio.log", "a") as f:
+                    f.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "instance": worst.name,
+                                        "rate": rate, "median": median, "old": worst.spec["options"],
+                                        "new": options, "scores": self.portfolio.rate}) + "\n")
+
+    async def run(self):
+        Path(self.out).mkdir(parents=True, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+        if self.port:
+            self.stats.serve(self.port)
+        self.scratch.start(loop)
+        for inst in list(self.instances):
+            if "scratch" in inst.spec:
+                self.scratch.setup(inst)
+            self.tasks.append(asyncio.create_task(self.keep_alive(inst)))
+        monitor = asyncio.create_task(self.monitor())
+        if self.relay:
+            self.tasks.append(asyncio.create_task(self.relay.run(self.stopping, argv_value("relay", 60.0))))
+        if self.node_sync:
+            self.tasks.append(asyncio.create_task(self.node_sync.run(self.stopping, argv_value("syncevery", 300.0))))
+        if self.checkpointer:
+            # waits for the instances to be stopped, then takes a final checkpoint
+            checkpoint = asyncio.create_task(self.checkpointer.run(self.stopping))
+        if self.make_spec and self.epoch_seconds:
+            self.tasks.append(asyncio.create_task(self.adapt()))
+        if self.make_spec and self.portfolio_seconds:
+            self.tasks.append(asyncio.create_task(self.rotate_options()))
+        await self.stopping.wait()
+
+        log("shutting down")
+        await asyncio.gather(*(self.stop_instance(inst) for inst in self.instances if inst.running()))
+        await asyncio.gather(*self.tasks, monitor)
+        if self.checkpointer:
+            await checkpoint
+        self.scratch.teardown()
+
+
+def instance_variant(name: str) -> str:
+    # secondaries are named <variant><index>
+    return re.sub(r"\d+$", "", name)
+
+# fuzzer_stats fields summed (or averaged) across instances, in display order
+STAT_FIELDS = ["execs_per_sec", "execs_done", "corpus_count", "corpus_found", "saved_crashes", "saved_hangs",
+               "cycles_done", "stability", "bitmap_cvg", "edges_found"]
+AVERAGED_FIELDS = {"stability", "bitmap_cvg"}
+
+def stat_number(value: str) -> float:
+    try:
+        return float(value.rstrip("%"))
+    except ValueError:
+        return 0.0
+
+class CampaignStats:
+    # incremental view over out/*/fuzzer_stats and plot_data. fuzzer_stats is only re-read
+    # when its mtime changes and plot_data is tailed from where we stopped, so a refresh costs
+    # a stat() per instance when nothing happened
+
+    def __init__(self, out: str):
+        self.out = Path(out)
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            entries = [e for e in os.scandir(self.out)
+                       if e.is_dir() and not e.name.startswith(".") and e.name not in (SYNC_NAME, RELAY_NAME)]
+            # grouped topology: instances live one level down, in out/sync_<group>/
+            for group in [e for e in entries if e.name.startswith("sync_")]:
+                entries.remove(group)
+                entries += [e for e in os.scandir(group.path) if e.is_dir() and e.name not in (SYNC_NAME, RELAY_NAME)]
+        except OSError:
+            return
+        with self.lock:
+            for entry in entries:
+                inst = self.instances.setdefault(entry.name, {
+                    "variant": instance_variant(entry.name),
+                    "stats_mtime": 0.0,
+                    "stats": {},
+                    "plot_offset": 0,
+                    "plot_columns": [],
+                    "plot_last": {},
+                })
+                self.refresh_stats(Path(entry.path), inst)
+                self.refresh_plot(Path(entry.path), inst)
+
+    def refresh_stats(self, path: Path, inst: dict):
+        try:
+            mtime = (path / "fuzzer_stats").stat().st_mtime
+        except OSError:
+            return
+        if mtime != inst["stats_mtime"]:
+            inst["stats_mtime"] = mtime
+            inst["stats"] = read_fuzzer_stats(path / "fuzzer_stats")
+
+    def refresh_plot(self, path: Path, inst: dict):
+        try:
+            with open(path / "plot_data", "rb") as f:
+                f.seek(inst["plot_offset"])
+                chunk = f.read()
+        except OSError:
+            return
+        # leave a partially written last line for next time
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        inst["plot_offset"] += len(complete)
+        for line in complete.decode(errors="replace").splitlines():
+            if line.startswith("#"):
+                inst["plot_columns"] = [c.strip() for c in line[1:].split(",")]
+            elif line.strip() and inst["plot_columns"]:
+                inst["plot_last"] = dict(zip(inst["plot_columns"], (stat_number(v) for v in line.split(","))))
+
+    def instance_values(self, inst: dict) -> dict:
+        values = {f: stat_number(inst["stats"].get(f, "0")) for f in STAT_FIELDS}
+        # plot_data is written more often than fuzzer_stats, prefer it where they overlap
+        plot = inst["plot_last"]
+        if "edges_found" in plot:
+            values["edges_found"] = plot["edges_found"]
+        if "execs_per_sec" in plot:
+            values["execs_per_sec"] = plot["execs_per_sec"]
+        if "saved_crashes" in plot:
+            values["saved_crashes"] = plot["saved_crashes"]
+        return values
+
+    def snapshot(self) -> dict:
+        # {"instances": {name: values}, "variants": {variant: values}, "total": values}
+        with self.lock:
+            per_instance = {name: dict(self.instance_values(inst), variant=inst["variant"])
+                            for name, inst in self.instances.items() if inst["stats"]}
+        per_variant = {}
+        for values in per_instance.values():
+            per_variant.setdefault(values["variant"], []).append(values)
+
+        def combine(rows):
+            combined = {"instances": len(rows)}
+            for f in STAT_FIELDS:
+                total = sum(r[f] for r in rows)
+                combined[f] = total / len(rows) if f in AVERAGED_FIELDS and rows else total
+            return combined
+
+        return {
+            "instances": per_instance,
+            "variants": {v: combine(rows) for v, rows in sorted(per_variant.items())},
+            "total": combine(list(per_instance.values())),
+        }
+
+    def summary(self) -> str:
+        snap = self.snapshot()
+        lines = [f"{'variant':16} {'n':>4} {'execs/s':>10} {'execs':>14} {'paths':>8} {'crashes':>8} "
+                 f"{'hangs':>6} {'cycles':>7} {'stab%':>6} {'cvg%':>6}"]
+        for name, v in list(snap["variants"].items()) + [("total", snap["total"])]:
+            lines.append(f"{name:16} {v['instances']:4} {v['execs_per_sec']:10.0f} {v['execs_done']:14.0f} "
+                         f"{v['corpus_count']:8.0f} {v['saved_crashes']:8.0f} {v['saved_hangs']:6.0f} "
+                         f"{v['cycles_done']:7.0f} {v['stability']:6.1f} {v['bitmap_cvg']:6.2f}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        snap = self.snapshot()
+        lines = []
+        for f in STAT_FIELDS:
+            lines.append(f"# TYPE afl_{f} gauge")
+            for name, values in sorted(snap["instances"].items()):
+                lines.append(f'afl_{f}{{instance="{name}",variant="{values["variant"]}"}} {values[f]}')
+        lines.append("# TYPE afl_instances gauge")
+        for variant, values in snap["variants"].items():
+            lines.append(f'afl_instances{{variant="{variant}"}} {values["instances"]}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int):
+        stats = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = stats.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        log(f"serving prometheus metrics on http://127.0.0.1:{port}/metrics")
+        return server
+
+def watch_stats(out: str, interval: float, port: int):
+    stats = CampaignStats(out)
+    stats.refresh()
+    if port:
+        stats.serve(port)
+    try:
+        while True:
+            print(stats.summary(), flush=True)
+            time.sleep(interval)
+            stats.refresh()
+    except KeyboardInterrupt:
+        pass
+
+
 '''
 export TMPDIR=/tmp
 export AFL_TMPDIR=/tmp
@@ -346,7 +2460,6 @@ export AFL_IMPORT_FIRST=1
 export AFL_FINAL_SYNC=1
 export AFL_INPUT_LEN_MIN=1
 export AFL_INPUT_LEN_MAX=10000000
-export AFL_NO_AFFINITY=1
 export AFL_SHUFFLE_QUEUE=1
 export AFL_SKIP_CPUFREQ=1
 export AFL_SYNC_TIME=1
@@ -356,15 +2469,54 @@ export AFL_FAST_CAL=1
 '''
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["linkgate"]:
+        sep = sys.argv.index("--")
+        sys.exit(link_gate(sys.argv[2], sys.argv[3], sys.argv[sep + 1:]))
+    if sys.argv[1:2] == ["relay"]:
+        run_relay(float(sys.argv[2]), sys.argv[3:])
+    if sys.argv[1:2] == ["nodesync"]:
+        # nodesync <interval> <out> [syncto=... node=...] <sync dirs>
+        dirs = [a for a in sys.argv[4:] if "=" not in a]
+        run_node_sync(node_sync_for([{"sync_dir": d} for d in dirs], sys.argv[3]), float(sys.argv[2]))
+    if sys.argv[1:2] == ["objcache"]:
+        sep = sys.argv.index("--")
+        sys.exit(object_cache(sys.argv[2], sys.argv[3], sys.argv[sep + 1:]))
     print(sys.argv)
-    if "ggml" in sys.argv:
-        if "commandsonly" in sys.argv:
-            print(gen_commands("ggml","corpus/gguf","out","bin/test-fuzz"))
+    if "stats" in sys.argv:
+        watch_stats(argv_value("out", "out"), argv_value("interval", 10.0), argv_value("port", 0))
+        sys.exit(0)
+    requested = [name for name in TARGETS if name in sys.argv]
+    if "benchmark" in sys.argv:
+        for name in requested:
+            target = TARGETS[name]
+            print(benchmark_report(run_benchmark(name, target["corpus"], target["executable"])))
+        sys.exit(0)
+    if "delivery" in sys.argv:
+        for name in requested:
+            measure_delivery(name, argv_value("seconds", 30))
+        sys.exit(0)
+    if "supervise" in sys.argv:
+        for name in requested:
+            target = TARGETS[name]
+            # ramout: afl works on tmpfs, out/ on disk only holds checkpoints
+            out = argv_value("ramdir", f"/dev/shm/fuzz_out/{name}") if "ramout" in sys.argv else "out"
+            checkpointer = Checkpointer(out, "out", argv_value("checkpoint", 300.0)) if "ramout" in sys.argv else None
+            if checkpointer:
+                # before anything scans the queues: the relay and node sync writers carry on from
+                # the ids already in their queue, which afl's .synced markers have recorded
+                checkpointer.restore()
+            specs = instance_specs(name, target["corpus"], out, target["executable"])
+            make_spec = partial(secondary_instance, name, target["corpus"], out, target["executable"])
+            epoch = argv_value("epoch", 3600.0) if "adaptive" in sys.argv else 0
+            asyncio.run(Supervisor(specs, out, argv_value("stall", 900.0), port=argv_value("port", 0),
+                                   make_spec=make_spec, epoch_seconds=epoch,
+                                   portfolio_seconds=argv_value("rotate", 1800.0) if "portfolio" in sys.argv else 0,
+                                   checkpointer=checkpointer, node_sync=node_sync_for(specs, out)).run())
             sys.exit(0)
-        ggml()
-    if "llama.cpp" in sys.argv:
-        if "commandsonly" in sys.argv:
-            print(gen_commands("llama.cpp","corpus/llama","out","bin/test-fuzz"))
+    if "commandsonly" in sys.argv:
+        for name in requested:
+            target = TARGETS[name]
+            print(gen_commands(name, target["corpus"], "out", target["executable"]))
             sys.exit(0)
-        llama_cpp()
-
+    if requested:
+        build_targets(requested, VARIANTS)
@@ -10,6 +10,7 @@ import string
 import numpy as np
 from typing import List, Tuple, Any
 import argparse
+import os
 
 # GGUF constants from the C++ code
 GGUF_MAGIC = b'GGUF'
@@ -32,7 +33,7 @@ class GGUFType:
     INT64 = 11
     FLOAT64 = 12
 
-# GGML types (tensor types)
+# GGML types (tensor types), numbered as in ggml.h
 class GGMLType:
     F32 = 0
     F16 = 1
@@ -42,20 +43,89 @@ class GGMLType:
     Q5_1 = 7
     Q8_0 = 8
     Q8_1 = 9
-    I8 = 16
-    I16 = 17
-    I32 = 18
+    Q2_K = 10
+    Q3_K = 11
+    Q4_K = 12
+    Q5_K = 13
+    Q6_K = 14
+    Q8_K = 15
+    IQ2_XXS = 16
+    IQ2_XS = 17
+    IQ3_XXS = 18
+    IQ1_S = 19
+    IQ4_NL = 20
+    IQ3_S = 21
+    IQ2_S = 22
+    IQ4_XS = 23
+    I8 = 24
+    I16 = 25
+    I32 = 26
+    I64 = 27
+    F64 = 28
+    IQ1_M = 29
+    BF16 = 30
+    TQ1_0 = 34
+    TQ2_0 = 35
+    MXFP4 = 39
 
-def write_string(data: bytearray, s: str):
-    """Write a GGUF string (uint64 length + UTF-8 data)"""
-    encoded = s.encode('utf-8')
-    data.extend(struct.pack('<Q', len(encoded)))
-    data.extend(encoded)
+QK_K = 256
 
-def write_padding(data: bytearray, alignment: int):
-    """Add padding to align to the specified boundary"""
-    while len(data) % alignment != 0:
-        data.append(0)
+# Tensor payload left as a hole: reads back as zeros, which is valid data for every type
+# (all scales 0), and takes no disk space on filesystems with sparse files
+SPARSE = object()
+
+# Bytes collected before GGUFWriter.write issues a writev, and the size of generated chunks
+WRITE_BATCH = 16 * 1024 * 1024
+
+# Block layouts from ggml-common.h: type -> (elements per block, dtype of one block).
+# type_size is the dtype's itemsize.
+GGML_BLOCKS = {
+    GGMLType.F32: (1, np.dtype('<f4')),
+    GGMLType.F16: (1, np.dtype('<f2')),
+    GGMLType.BF16: (1, np.dtype('<u2')),
+    GGMLType.F64: (1, np.dtype('<f8')),
+    GGMLType.I8: (1, np.dtype('i1')),
+    GGMLType.I16: (1, np.dtype('<i2')),
+    GGMLType.I32: (1, np.dtype('<i4')),
+    GGMLType.I64: (1, np.dtype('<i8')),
+    GGMLType.Q4_0: (32, np.dtype([('d', '<f2'), ('qs', 'u1', 16)])),
+    GGMLType.Q4_1: (32, np.dtype([('d', '<f2'), ('m', '<f2'), ('qs', 'u1', 16)])),
+    GGMLType.Q5_0: (32, np.dtype([('d', '<f2'), ('qh', 'u1', 4), ('qs', 'u1', 16)])),
+    GGMLType.Q5_1: (32, np.dtype([('d', '<f2'), ('m', '<f2'), ('qh', 'u1', 4), ('qs', 'u1', 16)])),
+    GGMLType.Q8_0: (32, np.dtype([('d', '<f2'), ('qs', 'i1', 32)])),
+    GGMLType.Q8_1: (32, np.dtype([('d', '<f2'), ('s', '<f2'), ('qs', 'i1', 32)])),
+    GGMLType.Q2_K: (QK_K, np.dtype([('scales', 'u1', 16), ('qs', 'u1', 64), ('d', '<f2'), ('dmin', '<f2')])),
+    GGMLType.Q3_K: (QK_K, np.dtype([('hmask', 'u1', 32), ('qs', 'u1', 64), ('scales', 'u1', 12), ('d', '<f2')])),
+    GGMLType.Q4_K: (QK_K, np.dtype([('d', '<f2'), ('dmin', '<f2'), ('scales', 'u1', 12), ('qs', 'u1', 128)])),
+    GGMLType.Q5_K: (QK_K, np.dtype([('d', '<f2'), ('dmin', '<f2'), ('scales', 'u1', 12), ('qh', 'u1', 32),
+                                    ('qs', 'u1', 128)])),
+    GGMLType.Q6_K: (QK_K, np.dtype([('ql', 'u1', 128), ('qh', 'u1', 64), ('scales', 'i1', 16), ('d', '<f2')])),
+    GGMLType.Q8_K: (QK_K, np.dtype([('d', '<f4'), ('qs', 'i1', 256), ('bsums', '<i2', 16)])),
+    GGMLType.IQ2_XXS: (QK_K, np.dtype([('d', '<f2'), ('qs', '<u2', 32)])),
+    GGMLType.IQ2_XS: (QK_K, np.dtype([('d', '<f2'), ('qs', '<u2', 32), ('scales', 'u1', 8)])),
+    GGMLType.IQ3_XXS: (QK_K, np.dtype([('d', '<f2'), ('qs', 'u1', 96)])),
+    GGMLType.IQ1_S: (QK_K, np.dtype([('d', '<f2'), ('qs', 'u1', 32), ('qh', '<u2', 8)])),
+    GGMLType.IQ4_NL: (32, np.dtype([('d', '<f2'), ('qs', 'u1', 16)])),
+    GGMLType.IQ3_S: (QK_K, np.dtype([('d', '<f2'), ('qs', 'u1', 64), ('qh', 'u1', 8), ('signs', 'u1', 32),
+                                     ('scales', 'u1', 4)])),
+    GGMLType.IQ2_S: (QK_K, np.dtype([('d', '<f2'), ('qs', 'u1', 64), ('qh', 'u1', 8), ('scales', 'u1', 8)])),
+    GGMLType.IQ4_XS: (QK_K, np.dtype([('d', '<f2'), ('scales_h', '<u2'), ('scales_l', 'u1', 4),
+                                      ('qs', 'u1', 128)])),
+    # IQ1_M has no d field, its fp16 scale is spread over the top nibbles of scales
+    GGMLType.IQ1_M: (QK_K, np.dtype([('qs', 'u1', 32), ('qh', 'u1', 16), ('scales', '<u2', 4)])),
+    GGMLType.TQ1_0: (QK_K, np.dtype([('qs', 'u1', 48), ('qh', 'u1', 4), ('d', '<f2')])),
+    GGMLType.TQ2_0: (QK_K, np.dtype([('qs', 'u1', 64), ('d', '<f2')])),
+    # e is an E8M0 exponent, 0xff is NaN
+    GGMLType.MXFP4: (32, np.dtype([('e', 'u1'), ('qs', 'u1', 16)])),
+}
+
+def blck_size(ggml_type: int) -> int:
+    """Number of elements in one block of the type"""
+    return GGML_BLOCKS[ggml_type][0]
+
+def type_size(ggml_type: int) -> int:
+    """Size in bytes of one block of the type"""
+    return GGML_BLOCKS[ggml_type][1].itemsize
 
 def random_string(min_len=1, max_len=20):
     """Generate a random string"""
@@ -134,9 +204,40 @@ def generate_random_value(gguf_type: int) -> Tuple[Any, bytes]:
     else:
         raise ValueError(f"Unknown GGUF type: {gguf_type}")
 
+def generate_tensor_chunks(shape: List[int], ggml_type: int, chunk_bytes: int = WRITE_BATCH):
+    """Yield random tensor data in chunks of whole blocks, about chunk_bytes each"""
+    block = blck_size(ggml_type)
+    n_blocks = int(np.prod(shape)) // block
+    per_chunk = max(1, chunk_bytes // type_size(ggml_type))
+    for start in range(0, n_blocks, per_chunk):
+        yield generate_tensor_data([min(per_chunk, n_blocks - start) * block], ggml_type)
+
+def random_scales(shape) -> np.ndarray:
+    """Random finite scales of the magnitude real quantization produces"""
+    return np.random.standard_normal(shape) * 0.01
+
+def generate_blocks(ggml_type: int, n_blocks: int) -> np.ndarray:
+    """Generate random quant blocks: random packed quants and grid indices, valid scales"""
+    dtype = GGML_BLOCKS[ggml_type][1]
+    # Every bit pattern is a valid quant, sign or grid index, so start from random bytes
+    # and only overwrite the scales
+    blocks = np.random.randint(0, 256, n_blocks * dtype.itemsize, dtype=np.uint8).view(dtype)
+    for name in dtype.names:
+        if dtype[name].kind == 'f':
+            blocks[name] = random_scales(blocks[name].shape)
+    if ggml_type == GGMLType.MXFP4:
+        # Exponents around 2^0
+        blocks['e'] = np.random.randint(117, 138, n_blocks)
+    elif ggml_type == GGMLType.IQ1_M:
+        # Nibble k of the fp16 scale lives in the top nibble of scales[k]
+        d = random_scales(n_blocks).astype('<f2').view('<u2')
+        nibbles = (d[:, None] >> (4 * np.arange(4, dtype=np.uint16))) & 0xf
+        blocks['scales'] = (blocks['scales'] & 0x0fff) | (nibbles << 12)
+    return blocks
+
 def generate_tensor_data(shape: List[int], ggml_type: int) -> bytes:
     """Generate random tensor data based on shape and type"""
-    n_elements = np.prod(shape)
+    n_elements = int(np.prod(shape))
     
     if ggml_type == GGMLType.F32:
         data = np.random.randn(n_elements).astype(np.float32)
@@ -144,243 +245,306 @@ def generate_tensor_data(shape: List[int], ggml_type: int) -> bytes:
     elif ggml_type == GGMLType.F16:
         data = np.random.randn(n_elements).astype(np.float16)
         return data.tobytes()
-    elif ggml_type == GGMLType.I8:
-        data = np.random.randint(-128, 127, size=n_elements, dtype=np.int8)
-        return data.tobytes()
-    elif ggml_type == GGMLType.I16:
-        data = np.random.randint(-32768, 32767, size=n_elements, dtype=np.int16)
+    elif ggml_type == GGMLType.BF16:
+        # bf16 is the top half of a float32
+        data = np.random.randn(n_elements).astype(np.float32).view(np.uint32) >> 16
+        return data.astype(np.uint16).tobytes()
+    elif ggml_type == GGMLType.F64:
+        data = np.random.randn(n_elements).astype(np.float64)
         return data.tobytes()
-    elif ggml_type == GGMLType.I32:
-        data = np.random.randint(-2**31, 2**31-1, size=n_elements, dtype=np.int32)
+    elif ggml_type in (GGMLType.I8, GGMLType.I16, GGMLType.I32, GGMLType.I64):
+        dtype = GGML_BLOCKS[ggml_type][1]
+        info = np.iinfo(dtype)
+        data = np.random.randint(info.min, info.max, size=n_elements, dtype=dtype)
         return data.tobytes()
     else:
-        # For quantized types, just generate random bytes
-        # In real GGUF files these would be properly quantized
-        if ggml_type in [GGMLType.Q4_0, GGMLType.Q4_1]:
-            # Q4 types pack data more densely
-            block_size = 32
-            n_blocks = (n_elements + block_size - 1) // block_size
-            if ggml_type == GGMLType.Q4_0:
-                bytes_per_block = 18  # 2 + 16 bytes
-            else:
-                bytes_per_block = 20  # 2 + 2 + 16 bytes
-            return bytes(random.getrandbits(8) for _ in range(n_blocks * bytes_per_block))
-        elif ggml_type in [GGMLType.Q5_0, GGMLType.Q5_1]:
-            block_size = 32
-            n_blocks = (n_elements + block_size - 1) // block_size
-            if ggml_type == GGMLType.Q5_0:
-                bytes_per_block = 22  # More complex packing
-            else:
-                bytes_per_block = 24
-            return bytes(random.getrandbits(8) for _ in range(n_blocks * bytes_per_block))
-        elif ggml_type == GGMLType.Q8_0:
-            block_size = 32
-            n_blocks = (n_elements + block_size - 1) // block_size
-            bytes_per_block = 34  # 2 + 32 bytes
-            return bytes(random.getrandbits(8) for _ in range(n_blocks * bytes_per_block))
-        else:
-            # Default: treat as float32
-            data = np.random.randn(n_elements).astype(np.float32)
-            return data.tobytes()
+        # ne0 is a multiple of the block size, so the tensor is a whole number of blocks
+        return generate_blocks(ggml_type, n_elements // blck_size(ggml_type)).tobytes()
 
-def generate_random_gguf(max_size_kb: int = 100) -> bytes:
-    """Generate a random GGUF file"""
-    data = bytearray()
-    
-    # Write magic
-    data.extend(GGUF_MAGIC)
-    
-    # Write version
-    data.extend(struct.pack('<I', GGUF_VERSION))
+# struct formats of the scalar GGUF types
+GGUF_SCALAR_FORMATS = {
+    GGUFType.UINT8: 'B',
+    GGUFType.INT8: 'b',
+    GGUFType.UINT16: 'H',
+    GGUFType.INT16: 'h',
+    GGUFType.UINT32: 'I',
+    GGUFType.INT32: 'i',
+    GGUFType.FLOAT32: 'f',
+    GGUFType.BOOL: 'b',
+    GGUFType.UINT64: 'Q',
+    GGUFType.INT64: 'q',
+    GGUFType.FLOAT64: 'd',
+}
+
+class GGUFWriter:
+    """Layout-first GGUF writer.
+
+    KV pairs and tensor infos are collected first. layout() then computes the
+    tensor offsets, the alignment padding and the exact file size, and the file
+    is serialized in one pass: into a preallocated buffer (to_bytes) or straight
+    to a file (write). Tensor payloads may be given as callables, which are only
+    called while writing, so a payload is never held longer than it takes to write it,
+    as chunk iterators for tensors too large to hold at all, or as SPARSE holes.
+    """
+
+    def __init__(self, alignment: int = GGUF_DEFAULT_ALIGNMENT, version: int = GGUF_VERSION):
+        self.alignment = alignment
+        self.version = version
+        self.kv = []
+        self.tensors = []
+
+    def add_kv(self, key: str, gguf_type: int, value: Any):
+        """Add a KV pair. ARRAY values are (element type, list of values)"""
+        self.kv.append((key.encode('utf-8'), gguf_type, self._encode(gguf_type, value)))
+
+    def add_tensor(self, name: str, shape: List[int], ggml_type: int, data: Any = b'', nbytes: int = None):
+        """Add a tensor. data is bytes-like, an iterable of bytes-like chunks, SPARSE,
+        or a callable returning bytes-like or chunks"""
+        if nbytes is None:
+            nbytes = int(np.prod(shape)) // blck_size(ggml_type) * type_size(ggml_type)
+        self.tensors.append({'name': name.encode('utf-8'), 'shape': list(shape), 'type': ggml_type,
+                             'data': data, 'nbytes': nbytes, 'offset': 0})
+
+    def _encode(self, gguf_type: int, value: Any) -> Any:
+        if gguf_type == GGUFType.STRING:
+            return value.encode('utf-8') if isinstance(value, str) else value
+        if gguf_type == GGUFType.ARRAY:
+            elem_type, items = value
+            return elem_type, [self._encode(elem_type, item) for item in items]
+        return value
+
+    def _value_size(self, gguf_type: int, value: Any) -> int:
+        if gguf_type == GGUFType.STRING:
+            return 8 + len(value)
+        if gguf_type == GGUFType.ARRAY:
+            elem_type, items = value
+            if elem_type in GGUF_SCALAR_FORMATS:
+                return 12 + len(items) * struct.calcsize(GGUF_SCALAR_FORMATS[elem_type])
+            return 12 + sum(self._value_size(elem_type, item) for item in items)
+        return struct.calcsize(GGUF_SCALAR_FORMATS[gguf_type])
+
+    def _align(self, offset: int) -> int:
+        return offset + (-offset % self.alignment)
+
+    def header_size(self) -> int:
+        """Size of everything before the alignment padding of the data section"""
+        size = 4 + 4 + 8 + 8
+        for key, gguf_type, value in self.kv:
+            size += 8 + len(key) + 4 + self._value_size(gguf_type, value)
+        for tensor in self.tensors:
+            size += 8 + len(tensor['name']) + 4 + 8 * len(tensor['shape']) + 4 + 8
+        return size
+
+    def layout(self) -> int:
+        """Compute tensor offsets and return the exact file size"""
+        offset = 0
+        for tensor in self.tensors:
+            tensor['offset'] = offset
+            offset = self._align(offset + tensor['nbytes'])
+        self.data_start = self._align(self.header_size())
+        # A file without tensors ends right after its header
+        return self.data_start + offset if self.tensors else self.header_size()
+
+    def _pack_value(self, buf, pos: int, gguf_type: int, value: Any) -> int:
+        if gguf_type == GGUFType.STRING:
+            struct.pack_into('<Q', buf, pos, len(value))
+            buf[pos + 8:pos + 8 + len(value)] = value
+            return pos + 8 + len(value)
+        if gguf_type == GGUFType.ARRAY:
+            elem_type, items = value
+            struct.pack_into('<iQ', buf, pos, elem_type, len(items))
+            pos += 12
+            if elem_type in GGUF_SCALAR_FORMATS:
+                fmt = f'<{len(items)}{GGUF_SCALAR_FORMATS[elem_type]}'
+                struct.pack_into(fmt, buf, pos, *items)
+                return pos + struct.calcsize(fmt)
+            for item in items:
+                pos = self._pack_value(buf, pos, elem_type, item)
+            return pos
+        fmt = '<' + GGUF_SCALAR_FORMATS[gguf_type]
+        struct.pack_into(fmt, buf, pos, value)
+        return pos + struct.calcsize(fmt)
+
+    def _pack_header(self, buf):
+        struct.pack_into('<4sIqq', buf, 0, GGUF_MAGIC, self.version, len(self.tensors), len(self.kv))
+        pos = 24
+        for key, gguf_type, value in self.kv:
+            pos = self._pack_value(buf, pos, GGUFType.STRING, key)
+            struct.pack_into('<i', buf, pos, gguf_type)
+            pos = self._pack_value(buf, pos + 4, gguf_type, value)
+        for tensor in self.tensors:
+            pos = self._pack_value(buf, pos, GGUFType.STRING, tensor['name'])
+            n_dims = len(tensor['shape'])
+            struct.pack_into(f'<I{n_dims}qiQ', buf, pos, n_dims, *tensor['shape'], tensor['type'], tensor['offset'])
+            pos += 4 + 8 * n_dims + 4 + 8
+
+    def _chunks(self, tensor):
+        """The tensor's payload as an iterator of byte chunks, None for a SPARSE tensor"""
+        data = tensor['data']
+        if data is SPARSE:
+            return None
+        if callable(data):
+            data = data()
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data).view(np.uint8)
+        if isinstance(data, (bytes, bytearray, memoryview, np.ndarray)):
+            data = [data]
+        return self._checked(tensor, (memoryview(chunk).cast('B') for chunk in data))
+
+    def _checked(self, tensor, chunks):
+        total = 0
+        for chunk in chunks:
+            total += len(chunk)
+            yield chunk
+        if total != tensor['nbytes']:
+            raise ValueError(f"tensor {tensor['name'].decode()}: {total} bytes of data, "
+                             f"{tensor['nbytes']} expected")
+
+    def to_bytes(self) -> bytes:
+        """Serialize into one preallocated buffer"""
+        buf = bytearray(self.layout())
+        self._pack_header(buf)
+        view = memoryview(buf)
+        for tensor in self.tensors:
+            pos = self.data_start + tensor['offset']
+            for chunk in self._chunks(tensor) or []:
+                view[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+        return bytes(buf)
+
+    def write(self, path: str) -> int:
+        """Serialize to a file and return its size. Buffers go out with one writev per
+        WRITE_BATCH bytes and SPARSE tensors are seeked over, so memory use does not
+        depend on the file size"""
+        size = self.layout()
+        header = bytearray(self.data_start if self.tensors else size)
+        self._pack_header(header)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # end is where the file stands once the pending buffers are written
+            pending = [memoryview(header)]
+            pending_bytes = end = len(header)
+            for tensor in self.tensors:
+                start = self.data_start + tensor['offset']
+                chunks = self._chunks(tensor)
+                if chunks is None:
+                    _writev_all(fd, pending)
+                    pending, pending_bytes = [], 0
+                    end = start + tensor['nbytes']
+                    os.lseek(fd, end, os.SEEK_SET)
+                    continue
+                # Alignment padding in front of the payload
+                pending.append(memoryview(bytes(start - end)))
+                pending_bytes += start - end
+                end = start
+                for chunk in chunks:
+                    pending.append(chunk)
+                    pending_bytes += len(chunk)
+                    end += len(chunk)
+                    if pending_bytes >= WRITE_BATCH:
+                        _writev_all(fd, pending)
+                        pending, pending_bytes = [], 0
+            _writev_all(fd, pending)
+            # Trailing padding, and the hole of a SPARSE last tensor
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        return size
+
+def _writev_all(fd: int, buffers: list):
+    """os.writev until every buffer is written"""
+    buffers = [b for b in buffers if len(b)]
+    while buffers:
+        written = os.writev(fd, buffers)
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if written:
+            buffers[0] = buffers[0][written:]
+
+def build_random_gguf(max_size_kb: int = 100) -> GGUFWriter:
+    """Lay out a random GGUF file; payloads are generated when it is written"""
+    writer = GGUFWriter()
     
     # Decide on number of tensors
     n_tensors = random.randint(1, 5)
     
-    # We'll count KV pairs as we add them
-    # Reserve space for tensor count and KV count (we'll update KV count later)
-    data.extend(struct.pack('<q', n_tensors))
-    kv_count_pos = len(data)
-    data.extend(struct.pack('<q', 0))  # Placeholder for KV count
-    
-    # Generate and write KV pairs
-    kv_pairs = []
-    kv_count = 0
-    
     # Add standard metadata first
     architectures = ['llama', 'mpt', 'gptneox', 'gptj', 'gpt2', 'bloom', 'falcon', 'mamba', 'rwkv']
     arch = random.choice(architectures)
     
     # Required: general.architecture
-    write_string(data, "general.architecture")
-    data.extend(struct.pack('<i', GGUFType.STRING))
-    write_string(data, arch)
-    kv_pairs.append(("general.architecture", arch))
-    kv_count += 1
+    writer.add_kv("general.architecture", GGUFType.STRING, arch)
     
     # Required: general.alignment (even though spec says it can be omitted)
-    write_string(data, "general.alignment")
-    data.extend(struct.pack('<i', GGUFType.UINT32))
-    data.extend(struct.pack('<I', GGUF_DEFAULT_ALIGNMENT))
-    kv_pairs.append(("general.alignment", GGUF_DEFAULT_ALIGNMENT))
-    kv_count += 1
+    writer.add_kv("general.alignment", GGUFType.UINT32, GGUF_DEFAULT_ALIGNMENT)
     
     # Optional but common: general.name
     if random.random() < 0.8:
-        model_name = f"test-model-{random.randint(1, 100)}"
-        write_string(data, "general.name")
-        data.extend(struct.pack('<i', GGUFType.STRING))
-        write_string(data, model_name)
-        kv_pairs.append(("general.name", model_name))
-        kv_count += 1
+        writer.add_kv("general.name", GGUFType.STRING, f"test-model-{random.randint(1, 100)}")
     
     # Optional: general.author
     if random.random() < 0.5:
-        write_string(data, "general.author")
-        data.extend(struct.pack('<i', GGUFType.STRING))
-        write_string(data, "GGUF Fuzzer")
-        kv_pairs.append(("general.author", "GGUF Fuzzer"))
-        kv_count += 1
+        writer.add_kv("general.author", GGUFType.STRING, "GGUF Fuzzer")
     
     # Optional: general.version
     if random.random() < 0.5:
-        write_string(data, "general.version")
-        data.extend(struct.pack('<i', GGUFType.STRING))
-        version = f"{random.randint(1, 3)}.{random.randint(0, 9)}"
-        write_string(data, version)
-        kv_pairs.append(("general.version", version))
-        kv_count += 1
+        writer.add_kv("general.version", GGUFType.STRING, f"{random.randint(1, 3)}.{random.randint(0, 9)}")
     
     # Optional: general.description
     if random.random() < 0.3:
-        write_string(data, "general.description")
-        data.extend(struct.pack('<i', GGUFType.STRING))
-        desc = "A randomly generated GGUF file for fuzzing purposes"
-        write_string(data, desc)
-        kv_pairs.append(("general.description", desc))
-        kv_count += 1
+        writer.add_kv("general.description", GGUFType.STRING, "A randomly generated GGUF file for fuzzing purposes")
     
     # Optional: general.file_type (enum)
     if random.random() < 0.7:
-        write_string(data, "general.file_type")
-        data.extend(struct.pack('<i', GGUFType.UINT32))
         file_type = random.choice([0, 1, 2, 3, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18])
-        data.extend(struct.pack('<I', file_type))
-        kv_pairs.append(("general.file_type", file_type))
-        kv_count += 1
+        writer.add_kv("general.file_type", GGUFType.UINT32, file_type)
     
     # Architecture-specific metadata
     if arch == 'llama':
         # Add some llama-specific metadata
-        write_string(data, "llama.context_length")
-        data.extend(struct.pack('<i', GGUFType.UINT64))
-        ctx_len = random.choice([2048, 4096, 8192, 16384, 32768])
-        data.extend(struct.pack('<Q', ctx_len))
-        kv_pairs.append(("llama.context_length", ctx_len))
-        kv_count += 1
-        
-        write_string(data, "llama.embedding_length")
-        data.extend(struct.pack('<i', GGUFType.UINT64))
-        emb_len = random.choice([2048, 4096, 5120, 6656])
-        data.extend(struct.pack('<Q', emb_len))
-        kv_pairs.append(("llama.embedding_length", emb_len))
-        kv_count += 1
-        
-        write_string(data, "llama.block_count")
-        data.extend(struct.pack('<i', GGUFType.UINT64))
-        block_count = random.choice([24, 32, 40, 48, 60, 80])
-        data.extend(struct.pack('<Q', block_count))
-        kv_pairs.append(("llama.block_count", block_count))
-        kv_count += 1
-        
-        write_string(data, "llama.attention.head_count")
-        data.extend(struct.pack('<i', GGUFType.UINT64))
-        head_count = random.choice([32, 40, 52, 64])
-        data.extend(struct.pack('<Q', head_count))
-        kv_pairs.append(("llama.attention.head_count", head_count))
-        kv_count += 1
+        writer.add_kv("llama.context_length", GGUFType.UINT64, random.choice([2048, 4096, 8192, 16384, 32768]))
+        writer.add_kv("llama.embedding_length", GGUFType.UINT64, random.choice([2048, 4096, 5120, 6656]))
+        writer.add_kv("llama.block_count", GGUFType.UINT64, random.choice([24, 32, 40, 48, 60, 80]))
+        writer.add_kv("llama.attention.head_count", GGUFType.UINT64, random.choice([32, 40, 52, 64]))
     
     # Tokenizer metadata
     if random.random() < 0.5:
-        write_string(data, "tokenizer.ggml.model")
-        data.extend(struct.pack('<i', GGUFType.STRING))
-        tokenizer_model = random.choice(['llama', 'replit', 'gpt2', 'rwkv'])
-        write_string(data, tokenizer_model)
-        kv_pairs.append(("tokenizer.ggml.model", tokenizer_model))
-        kv_count += 1
+        writer.add_kv("tokenizer.ggml.model", GGUFType.STRING, random.choice(['llama', 'replit', 'gpt2', 'rwkv']))
         
         # Add some token IDs
-        write_string(data, "tokenizer.ggml.bos_token_id")
-        data.extend(struct.pack('<i', GGUFType.UINT32))
-        bos_id = random.randint(1, 10)
-        data.extend(struct.pack('<I', bos_id))
-        kv_pairs.append(("tokenizer.ggml.bos_token_id", bos_id))
-        kv_count += 1
-        
-        write_string(data, "tokenizer.ggml.eos_token_id")
-        data.extend(struct.pack('<i', GGUFType.UINT32))
-        eos_id = random.randint(1, 10)
-        data.extend(struct.pack('<I', eos_id))
-        kv_pairs.append(("tokenizer.ggml.eos_token_id", eos_id))
-        kv_count += 1
+        writer.add_kv("tokenizer.ggml.bos_token_id", GGUFType.UINT32, random.randint(1, 10))
+        writer.add_kv("tokenizer.ggml.eos_token_id", GGUFType.UINT32, random.randint(1, 10))
     
     # Add remaining random KV pairs (aim for 10-25 total)
     target_kv = random.randint(10, 25)
-    for _ in range(max(0, target_kv - kv_count)):
+    for _ in range(max(0, target_kv - len(writer.kv))):
         key = random_key()
         
         # Decide if it's an array or single value
         is_array = random.random() < 0.3
         
         if is_array:
-            # Array type
-            write_string(data, key)
-            data.extend(struct.pack('<i', GGUFType.ARRAY))
-            
             # Choose array element type (exclude ARRAY and handle STRING specially)
             arr_type = random.choice([GGUFType.UINT8, GGUFType.INT32, GGUFType.FLOAT32, 
                                     GGUFType.BOOL, GGUFType.STRING])
-            data.extend(struct.pack('<i', arr_type))
             
             # Array length
             arr_len = random.randint(1, 10)
-            data.extend(struct.pack('<Q', arr_len))
             
-            # Array data
             if arr_type == GGUFType.STRING:
-                # String array - write each string separately
-                for j in range(arr_len):
-                    string_val = f"array_str_{j}"
-                    write_string(data, string_val)
+                items = [f"array_str_{j}" for j in range(arr_len)]
             else:
-                # Numeric/bool array
-                for _ in range(arr_len):
-                    _, val_data = generate_random_value(arr_type)
-                    data.extend(val_data)
-            
-            kv_pairs.append((key, f"array[{arr_len}]"))
+                items = [generate_random_value(arr_type)[0] for _ in range(arr_len)]
+            writer.add_kv(key, GGUFType.ARRAY, (arr_type, items))
         else:
             # Single value (exclude ARRAY type which is 9)
             value_type = random.choice([0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12])
             
-            write_string(data, key)
-            data.extend(struct.pack('<i', value_type))
-            
             if value_type == GGUFType.STRING:
-                string_val = random_string()
-                write_string(data, string_val)
-                kv_pairs.append((key, string_val))
+                writer.add_kv(key, value_type, random_string())
             else:
-                val, val_data = generate_random_value(value_type)
-                data.extend(val_data)
-                kv_pairs.append((key, val))
-    
-    # Update the KV count in the header
-    final_kv_count = len(kv_pairs)
-    struct.pack_into('<q', data, kv_count_pos, final_kv_count)
-    
-    # Generate and write tensor info
-    tensors = []
-    tensor_data_size = 0
+                writer.add_kv(key, value_type, generate_random_value(value_type)[0])
     
     # Use standardized tensor names from the spec
     base_tensor_names = ['token_embd', 'pos_embd', 'output_norm', 'output']
@@ -398,71 +562,86 @@ def generate_random_gguf(max_size_kb: int = 100) -> bytes:
         elif random.random() < 0.7:
             # Block layer tensor
             block_num = random.randint(0, 31)
-            tensor_type = random.choice(block_tensor_names)
+            tensor_name = random.choice(block_tensor_names)
             suffix = ".weight" if random.random() < 0.9 else ".bias"
-            name = f"blk.{block_num}.{tensor_type}{suffix}"
+            name = f"blk.{block_num}.{tensor_name}{suffix}"
         else:
             # Fallback to generic name
             name = f"tensor_{i}"
         
-        write_string(data, name)
-        
         # Number of dimensions (1-4)
         n_dims = random.randint(1, 4)
-        data.extend(struct.pack('<I', n_dims))
+        
+        # Tensor type, any ggml type so every dequant path gets exercised
+        tensor_type = random.choice(list(GGML_BLOCKS))
+        block = blck_size(tensor_type)
         
         # Shape - keep it small
         shape = []
-        remaining_size = (max_size_kb * 1024 - len(data)) // n_tensors
+        remaining_size = (max_size_kb * 1024 - writer.header_size()) // n_tensors
         max_elements = min(remaining_size // 4, 1000)  # Assume float32
         
         for dim in range(n_dims):
             if dim == 0:
-                # First dimension can be larger
-                dim_size = random.randint(1, min(64, max_elements))
+                # First dimension can be larger, and has to be a whole number of blocks
+                dim_size = block * random.randint(1, max(1, min(64, max_elements) // block))
             else:
                 # Keep other dimensions smaller
-                dim_size = random.randint(1, min(16, max_elements // np.prod(shape)))
+                dim_size = random.randint(1, max(1, min(16, max_elements // np.prod(shape))))
             shape.append(dim_size)
-            data.extend(struct.pack('<q', dim_size))
         
-        # Pad remaining dimensions with 1
-        for _ in range(n_dims, 4):
-            data.extend(struct.pack('<q', 1))
-        
-        # Tensor type
-        tensor_type = random.choice([GGMLType.F32, GGMLType.F16, GGMLType.I8, GGMLType.I16, GGMLType.I32])
-        data.extend(struct.pack('<i', tensor_type))
-        
-        # Offset (will be calculated later)
-        offset_pos = len(data)
-        data.extend(struct.pack('<Q', 0))  # Placeholder
-        
-        tensors.append({
-            'name': name,
-            'shape': shape,
-            'type': tensor_type,
-            'offset_pos': offset_pos
-        })
-    
-    # Align to GGUF_DEFAULT_ALIGNMENT before data section
-    write_padding(data, GGUF_DEFAULT_ALIGNMENT)
-    data_section_start = len(data)
+        # Only n_dims dimensions are stored, the loader fills the rest with 1
+        writer.add_tensor(name, shape, tensor_type, lambda shape=shape, tensor_type=tensor_type:
+                          generate_tensor_data(shape, tensor_type))
     
-    # Write tensor data
-    for i, tensor in enumerate(tensors):
-        # Calculate and update offset
-        offset = len(data) - data_section_start
-        struct.pack_into('<Q', data, tensor['offset_pos'], offset)
-        
-        # Generate and write tensor data
-        tensor_data = generate_tensor_data(tensor['shape'], tensor['type'])
-        data.extend(tensor_data)
+    return writer
+
+def seed_file_rng(master_seed: int, index: int, *stream: int):
+    """Seed the global random and numpy RNGs for one file from the master seed and its index,
+    so every file of a corpus is independent of the others and can be regenerated on its own"""
+    state = np.random.SeedSequence([master_seed, index, *stream]).generate_state(4)
+    random.seed(int.from_bytes(state.tobytes(), 'little'))
+    np.random.seed(state)
+
+def build_corpus_gguf(master_seed: int, index: int) -> GGUFWriter:
+    """Lay out random file number index of a corpus generated with master_seed"""
+    seed_file_rng(master_seed, index)
+    # Vary the size
+    max_size = random.choice([10, 50, 100, 200])
+    return build_random_gguf(max_size)
+
+def build_huge_gguf(total_bytes: int, fill: str = 'sparse') -> GGUFWriter:
+    """Lay out a GGUF file of about total_bytes: random metadata and small tensors followed
+    by a few huge ones, so sizes and offsets need 64 bits past 4 GiB. Huge payloads are
+    holes ('sparse'), random data generated chunk by chunk ('random') or either ('mixed')"""
+    writer = build_random_gguf(10)
+    n_huge = random.randint(1, 4)
+    for i in range(n_huge):
+        tensor_type = random.choice(list(GGML_BLOCKS))
+        ne0 = blck_size(tensor_type) * random.choice([1, 4, 16, 64])
+        row_bytes = ne0 // blck_size(tensor_type) * type_size(tensor_type)
+        shape = [ne0, max(1, total_bytes // n_huge // row_bytes)]
         
-        # Align each tensor
-        write_padding(data, GGUF_DEFAULT_ALIGNMENT)
+        tensor_fill = random.choice(['sparse', 'random']) if fill == 'mixed' else fill
+        if tensor_fill == 'sparse':
+            data = SPARSE
+        else:
+            data = lambda shape=shape, tensor_type=tensor_type: generate_tensor_chunks(shape, tensor_type)
+        writer.add_tensor(f"blk.{i}.ffn_up.weight", shape, tensor_type, data)
     
-    return bytes(data)
+    return writer
+
+def parse_size(text: str) -> int:
+    """Byte count with an optional K/M/G/T suffix (powers of 1024)"""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def generate_random_gguf(max_size_kb: int = 100) -> bytes:
+    """Generate a random GGUF file"""
+    return build_random_gguf(max_size_kb).to_bytes()
 
 def main():
     parser = argparse.ArgumentParser(description='Generate random GGUF files for fuzzing')
@@ -470,21 +649,35 @@ def main():
     parser.add_argument('--max-size', type=int, default=100, 
                         help='Maximum file size in KB (default: 100)')
     parser.add_argument('--seed', type=int, help='Random seed for reproducibility')
+    parser.add_argument('--huge', type=parse_size, metavar='SIZE',
+                        help='Write a file of about SIZE (e.g. 6G) with huge tensors, streamed to disk')
+    parser.add_argument('--fill', choices=['sparse', 'random', 'mixed'], default='sparse',
+                        help='Payload of the huge tensors: holes, random data or either (default: sparse)')
+    parser.add_argument('--index', type=int,
+                        help='Generate random_<index>.gguf of the generate_corpus.py corpus with master seed --seed '
+                             '(its size is part of the corpus, --max-size is ignored)')
     
     args = parser.parse_args()
     
-    if args.seed is not None:
-        random.seed(args.seed)
-        np.random.seed(args.seed)
-    
-    # Generate GGUF file
-    gguf_data = generate_random_gguf(args.max_size)
+    if args.huge is not None:
+        if args.seed is not None:
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+        writer = build_huge_gguf(args.huge, args.fill)
+    elif args.index is not None:
+        if args.seed is None:
+            parser.error("--index needs the corpus's --seed")
+        writer = build_corpus_gguf(args.seed, args.index)
+    else:
+        if args.seed is not None:
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+        writer = build_random_gguf(args.max_size)
     
-    # Write to file
-    with open(args.output, 'wb') as f:
-        f.write(gguf_data)
+    # Generate GGUF file, payloads are generated as they are written
+    size = writer.write(args.output)
     
-    print(f"Generated GGUF file: {args.output} ({len(gguf_data)} bytes)")
+    print(f"Generated GGUF file: {args.output} ({size} bytes)")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped GGUF reader and validator for corpus and crash inspection.
+Parses lazily straight out of the mapping: strings and tensor data are
+memoryview slices, scalar arrays are numpy views. Validation follows the checks
+ggml's gguf loader makes and reports the first malformed field and its offset.
+"""
+
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+from collections import Counter
+from functools import cached_property
+from multiprocessing import Pool
+from math import prod
+from typing import Any, List, NamedTuple
+
+import numpy as np
+
+from generate_gguf import (GGUF_MAGIC, GGUF_DEFAULT_ALIGNMENT, GGUF_SCALAR_FORMATS, GGUFType, GGMLType,
+                           GGML_BLOCKS, blck_size, type_size)
+
+# Limits of the loader (ggml.h)
+GGML_MAX_DIMS = 4
+GGML_MAX_NAME = 64
+
+GGUF_TYPE_NAMES = {v: k for k, v in vars(GGUFType).items() if k.isupper()}
+GGML_TYPE_NAMES = {v: k for k, v in vars(GGMLType).items() if k.isupper()}
+
+U32 = struct.Struct('<I')
+U64 = struct.Struct('<Q')
+COUNTS = struct.Struct('<qq')
+KV_TYPE = struct.Struct('<i')
+ARRAY_HEADER = struct.Struct('<iQ')
+TENSOR_TYPE_OFFSET = struct.Struct('<iQ')
+SHAPES = [struct.Struct(f'<{n}q') for n in range(GGML_MAX_DIMS + 1)]
+SCALAR_STRUCTS = {t: struct.Struct('<' + fmt) for t, fmt in GGUF_SCALAR_FORMATS.items()}
+
+# Smallest possible encodings, to reject absurd counts before looping over them
+MIN_KV_SIZE = 8 + 4 + 1
+MIN_TENSOR_INFO_SIZE = 8 + 4 + 4 + 8
+
+class GGUFError(ValueError):
+    """A malformed field: which one, where, and what is wrong with it"""
+
+    def __init__(self, offset: int, field: str, message: str):
+        super().__init__(f"{field} at offset {offset:#x}: {message}")
+        self.offset = offset
+        self.field = field
+        # Field without indices, e.g. "kv.value" or "tensor.offset", for statistics
+        self.kind = '.'.join(part.split('[')[0] for part in field.split('.'))
+        self.message = message
+
+    def __reduce__(self):
+        # Rebuild from the constructor arguments when sent back from a scan worker
+        return GGUFError, (self.offset, self.field, self.message)
+
+class TensorInfo(NamedTuple):
+    name: memoryview
+    shape: tuple
+    type: int
+    offset: int
+    # Position of n_dims, the shape, type and offset follow it
+    dims_offset: int
+
+class GGUFReader:
+    """Lazy GGUF reader over a read-only mmap.
+
+    The header is read on construction, the KV section and tensor infos on first
+    access to kv or tensors. Nothing is copied out of the mapping.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # An empty file can't be mapped
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.buf = memoryview(self.mm) if self.mm is not None else memoryview(b'')
+        self.size = size
+        try:
+            self._read_header()
+        except GGUFError:
+            self.close()
+            raise
+
+    def _read_header(self):
+        self.magic = bytes(self.buf[:4])
+        if self.magic != GGUF_MAGIC:
+            raise GGUFError(0, 'magic', f"{self.magic!r} is not {GGUF_MAGIC!r}")
+        self.version, = self._read(U32, 4, 'version')
+        if self.version == 1:
+            raise GGUFError(4, 'version', "GGUFv1 is no longer supported")
+        if self.version not in (2, 3):
+            raise GGUFError(4, 'version', f"unknown version {self.version}")
+        self.n_tensors, self.n_kv = self._read(COUNTS, 8, 'counts')
+        if self.n_tensors < 0 or self.n_tensors * MIN_TENSOR_INFO_SIZE > self.size:
+            raise GGUFError(8, 'n_tensors', f"{self.n_tensors} tensor infos can't fit in {self.size} bytes")
+        if self.n_kv < 0 or self.n_kv * MIN_KV_SIZE > self.size:
+            raise GGUFError(16, 'n_kv', f"{self.n_kv} KV pairs can't fit in {self.size} bytes")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Unmap the file, unless slices handed out are still alive"""
+        try:
+            self.buf.release()
+            if self.mm is not None:
+                self.mm.close()
+        except BufferError:
+            pass
+
+    # Field names are passed as a prefix and suffix and only joined for an error,
+    # formatting them for every field would dominate a corpus scan
+
+    def _read(self, fmt: struct.Struct, pos: int, field: str, suffix: str = '') -> tuple:
+        if pos + fmt.size > self.size:
+            raise GGUFError(pos, field + suffix,
+                            f"truncated, needs {fmt.size} bytes, file ends after {self.size - pos}")
+        return fmt.unpack_from(self.buf, pos)
+
+    def _read_string(self, pos: int, field: str, suffix: str = '') -> tuple:
+        if pos + 8 > self.size:
+            raise GGUFError(pos, field + suffix + '.length', f"truncated, file ends after {self.size - pos} bytes")
+        length, = U64.unpack_from(self.buf, pos)
+        end = pos + 8 + length
+        if end > self.size:
+            raise GGUFError(pos, field + suffix + '.length', f"{length} bytes past the end of the file")
+        return self.buf[pos + 8:end], end
+
+    def _read_value(self, pos: int, gguf_type: int, field: str) -> tuple:
+        if gguf_type in SCALAR_STRUCTS:
+            fmt = SCALAR_STRUCTS[gguf_type]
+            value, = self._read(fmt, pos, field, '.value')
+            return value, pos + fmt.size
+        if gguf_type == GGUFType.STRING:
+            return self._read_string(pos, field, '.value')
+        if gguf_type != GGUFType.ARRAY:
+            raise GGUFError(pos - 4, field + '.type', f"unknown type {gguf_type}")
+        field += '.value'
+        elem_type, count = self._read(ARRAY_HEADER, pos, field + '.header')
+        if elem_type == GGUFType.ARRAY:
+            raise GGUFError(pos, field + '.type', "nested arrays are not supported")
+        pos += ARRAY_HEADER.size
+        if elem_type in SCALAR_STRUCTS:
+            itemsize = SCALAR_STRUCTS[elem_type].size
+            if count > (self.size - pos) // itemsize:
+                raise GGUFError(pos - 8, field + '.count', f"{count} elements past the end of the file")
+            values = np.frombuffer(self.buf, '<' + GGUF_SCALAR_FORMATS[elem_type], count, pos)
+            return (elem_type, values), pos + count * itemsize
+        if elem_type != GGUFType.STRING:
+            raise GGUFError(pos - ARRAY_HEADER.size, field + '.type', f"unknown element type {elem_type}")
+        if count > (self.size - pos) // 8:
+            raise GGUFError(pos - 8, field + '.count', f"{count} strings past the end of the file")
+        values = []
+        read_string = self._read_string
+        for i in range(count):
+            value, pos = read_string(pos, field)
+            values.append(value)
+        return (elem_type, values), pos
+
+    @cached_property
+    def kv(self) -> dict:
+        """Key (str) -> (type, value); strings are memoryviews, scalar arrays numpy views"""
+        kv = {}
+        pos = 24
+        self._alignment_offset = 24
+        for i in range(self.n_kv):
+            start = pos
+            field = f"kv[{i}]"
+            key, pos = self._read_string(pos, field, '.key')
+            key = str(key, 'utf-8', 'backslashreplace')
+            if key in kv:
+                raise GGUFError(start, field + '.key', f"duplicate key {key}")
+            if key == 'general.alignment':
+                self._alignment_offset = start
+            gguf_type, = self._read(KV_TYPE, pos, field, '.type')
+            value, pos = self._read_value(pos + KV_TYPE.size, gguf_type, field)
+            kv[key] = (gguf_type, value)
+        self._kv_end = pos
+        return kv
+
+    @cached_property
+    def alignment(self) -> int:
+        gguf_type, value = self.kv.get('general.alignment', (GGUFType.UINT32, GGUF_DEFAULT_ALIGNMENT))
+        if gguf_type != GGUFType.UINT32:
+            raise GGUFError(self._alignment_offset, 'general.alignment',
+                            f"has type {GGUF_TYPE_NAMES.get(gguf_type, gguf_type)}, not UINT32")
+        if value == 0 or value & (value - 1):
+            raise GGUFError(self._alignment_offset, 'general.alignment', f"{value} is not a power of two")
+        return value
+
+    @cached_property
+    def tensors(self) -> List[TensorInfo]:
+        tensors = []
+        names = set()
+        # The tensor infos start where the KV section ends
+        self.kv
+        pos = self._kv_end
+        for i in range(self.n_tensors):
+            start = pos
+            field = f"tensor[{i}]"
+            name, pos = self._read_string(pos, field, '.name')
+            if len(name) >= GGML_MAX_NAME:
+                raise GGUFError(start, f"tensor[{i}].name", f"{len(name)} bytes, the limit is {GGML_MAX_NAME - 1}")
+            if name in names:
+                raise GGUFError(start, f"tensor[{i}].name", f"duplicate name {bytes(name)!r}")
+            names.add(bytes(name))
+            dims_offset = pos
+            n_dims, = self._read(U32, pos, field, '.n_dims')
+            if n_dims > GGML_MAX_DIMS:
+                raise GGUFError(pos, f"tensor[{i}].n_dims", f"{n_dims} dimensions, the limit is {GGML_MAX_DIMS}")
+            shape = self._read(SHAPES[n_dims], pos + 4, field, '.shape')
+            pos += 4 + 8 * n_dims
+            ggml_type, offset = self._read(TENSOR_TYPE_OFFSET, pos, field, '.type')
+            tensors.append(TensorInfo(name, shape, ggml_type, offset, dims_offset))
+            pos += TENSOR_TYPE_OFFSET.size
+        self._infos_end = pos
+        return tensors
+
+    @cached_property
+    def data_start(self) -> int:
+        """File offset of the tensor data section"""
+        self.tensors
+        return self._infos_end + (-self._infos_end % self.alignment)
+
+    def tensor_nbytes(self, tensor: TensorInfo) -> int:
+        return prod(tensor.shape) // blck_size(tensor.type) * type_size(tensor.type)
+
+    def tensor_data(self, tensor: TensorInfo) -> memoryview:
+        start = self.data_start + tensor.offset
+        return self.buf[start:start + self.tensor_nbytes(tensor)]
+
+    def validate(self):
+        """Check the whole file, raising GGUFError at the first malformed field"""
+        alignment = self.alignment
+        data_start = self.data_start
+        expected = 0
+        for i, tensor in enumerate(self.tensors):
+            shape_offset = tensor.dims_offset + 4
+            type_offset = shape_offset + 8 * len(tensor.shape)
+            if any(ne < 0 for ne in tensor.shape):
+                raise GGUFError(shape_offset, f"tensor[{i}].shape", f"negative dimension in {list(tensor.shape)}")
+            if prod(tensor.shape) > 2**63 - 1:
+                raise GGUFError(shape_offset, f"tensor[{i}].shape", f"{list(tensor.shape)} overflows int64 elements")
+            if tensor.type not in GGML_BLOCKS:
+                raise GGUFError(type_offset, f"tensor[{i}].type", f"unknown ggml type {tensor.type}")
+            if tensor.shape and tensor.shape[0] % blck_size(tensor.type):
+                raise GGUFError(shape_offset, f"tensor[{i}].shape",
+                                f"ne0 {tensor.shape[0]} is not a multiple of the "
+                                f"{GGML_TYPE_NAMES[tensor.type]} block size {blck_size(tensor.type)}")
+            # The loader wants tensors packed back to back, each padded to the alignment
+            if tensor.offset != expected:
+                raise GGUFError(type_offset + 4, f"tensor[{i}].offset", f"{tensor.offset}, expected {expected}")
+            nbytes = self.tensor_nbytes(tensor)
+            if data_start + tensor.offset + nbytes > self.size:
+                raise GGUFError(data_start + tensor.offset, f"tensor[{i}].data",
+                                f"{nbytes} bytes, file ends after {self.size - data_start - tensor.offset}")
+            expected += nbytes + (-nbytes % alignment)
+
+    def summary(self) -> dict:
+        """Statistics of one valid file"""
+        return {
+            'version': self.version,
+            'n_kv': self.n_kv,
+            'n_tensors': self.n_tensors,
+            'size': self.size,
+            'types': Counter(GGML_TYPE_NAMES[t.type] for t in self.tensors),
+        }
+
+def describe_value(gguf_type: int, value: Any, limit: int = 8) -> str:
+    if gguf_type == GGUFType.STRING:
+        return repr(str(value, 'utf-8', 'backslashreplace')[:80])
+    if gguf_type == GGUFType.ARRAY:
+        elem_type, items = value
+        shown = ', '.join(describe_value(elem_type, item) if elem_type == GGUFType.STRING else str(item)
+                          for item in items[:limit])
+        more = f", ... ({len(items)} total)" if len(items) > limit else ''
+        return f"{GGUF_TYPE_NAMES[elem_type]}[{shown}{more}]"
+    return str(value)
+
+def dump(path: str):
+    """Print one file: header, KV pairs, tensor infos, validation result"""
+    try:
+        with GGUFReader(path) as reader:
+            print(f"{path}: GGUF v{reader.version}, {reader.n_kv} KV pairs, {reader.n_tensors} tensors, "
+                  f"{len(reader.buf)} bytes")
+            for key, (gguf_type, value) in reader.kv.items():
+                print(f"  {key} ({GGUF_TYPE_NAMES.get(gguf_type)}): {describe_value(gguf_type, value)}")
+            print(f"  data section at {reader.data_start:#x}, alignment {reader.alignment}")
+            for tensor in reader.tensors:
+                print(f"  {str(tensor.name, 'utf-8', 'backslashreplace'):40} "
+                      f"{GGML_TYPE_NAMES.get(tensor.type, tensor.type):>8} {str(list(tensor.shape)):>24} "
+                      f"offset {tensor.offset:#x}")
+            reader.validate()
+            print("  valid")
+    except GGUFError as e:
+        print(f"  malformed: {e}")
+        return False
+    except OSError as e:
+        print(f"{path}: unreadable: {e}")
+        return False
+    return True
+
+def iter_files(paths: List[str]):
+    for path in paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        yield entry.path
+        else:
+            yield path
+
+def scan_file(path: str) -> tuple:
+    """Validate one file: (path, None, summary) or (path, error, None)"""
+    try:
+        with GGUFReader(path) as reader:
+            reader.validate()
+            return path, None, reader.summary()
+    except (GGUFError, OSError) as e:
+        return path, e, None
+
+def scan(paths: List[str], jobs: int = 1, verbose: bool = False):
+    """Validate many files and print summary statistics"""
+    start = time.perf_counter()
+    n_files = n_valid = total_size = 0
+    errors = Counter()
+    types = Counter()
+    versions = Counter()
+    files = list(iter_files(paths))
+    if jobs > 1 and len(files) > 1:
+        pool = Pool(jobs)
+        # Per-file work is tens of microseconds, large chunks keep IPC out of the way
+        results = pool.imap_unordered(scan_file, files, max(1, min(1024, len(files) // (jobs * 4))))
+    else:
+        pool = None
+        results = map(scan_file, files)
+    for path, error, summary in results:
+        n_files += 1
+        if error is not None:
+            errors[error.kind if isinstance(error, GGUFError) else 'unreadable'] += 1
+            if verbose:
+                print(f"{path}: {error}")
+            continue
+        n_valid += 1
+        total_size += summary['size']
+        types.update(summary['types'])
+        versions[summary['version']] += 1
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"{n_files} files in {elapsed:.2f}s ({n_files / max(elapsed, 1e-9):.0f} files/s), "
+          f"{n_valid} valid, {n_files - n_valid - errors['unreadable']} malformed"
+          + (f", {errors['unreadable']} unreadable" if errors['unreadable'] else ''))
+    if n_valid:
+        print(f"valid: {total_size / n_valid:.0f} bytes on average, versions "
+              + ', '.join(f"v{v}: {n}" for v, n in sorted(versions.items())))
+        print("tensor types: " + ', '.join(f"{t} {n}" for t, n in types.most_common()))
+    if errors:
+        print("first malformed field: " + ', '.join(f"{kind} {n}" for kind, n in errors.most_common()))
+
+def main():
+    parser = argparse.ArgumentParser(description='Read and validate GGUF files')
+    parser.add_argument('paths', nargs='+', help='GGUF files, or directories of them')
+    parser.add_argument('--scan', action='store_true',
+                        help='Only validate and print summary statistics (default for directories)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='Worker processes for --scan (default: one per CPU)')
+    parser.add_argument('--verbose', action='store_true', help='With --scan, print every malformed file')
+
+    args = parser.parse_args()
+
+    if args.scan or len(args.paths) > 1 or any(os.path.isdir(p) for p in args.paths):
+        scan(args.paths, args.jobs, args.verbose)
+    else:
+        sys.exit(0 if dump(args.paths[0]) else 1)
+
+if __name__ == '__main__':
+    main()